@@ -0,0 +1,245 @@
+import argparse
+import csv
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from ase.build import bulk
+from ase.io import write
+
+from phono3py import Phono3py
+
+import pyte.thirdorder.thirdorder_core as thirdorder_core
+from pyte.thirdorder.thirdorder_ase import from_atoms
+from pyte.thirdorder.thirdorder_common import (
+    SYMPREC,
+    gen_SPOSCAR,
+    calc_dists,
+    calc_frange,
+    write_ifcs,
+)
+from pyte.util.calc import calc_from_config
+from pyte.util.logger import Logger
+from pyte.util.phonopy_utils import aseatoms2phonoatoms
+from pyte.scripts.parse_input import parse_config
+from pyte.scripts.process_fcs import calculate_fc2, calculate_fc3_phono3py
+from pyte.scripts.process_conductivity import process_phono3py_conductivity
+
+STAGES = [
+    'gen_SPOSCAR',
+    'calc_dists',
+    'build_list4',
+    'reconstruct_ifcs',
+    'write_ifcs',
+    'calculate_fc2',
+    'calculate_fc3_phono3py',
+    'conductivity',
+]
+
+# the custom calc_type loads generate_calc() from a python script
+EMT_SCRIPT = """from ase.calculators.emt import EMT
+
+
+def generate_calc():
+    return EMT()
+"""
+
+
+def measure(func, *args, trace_memory=True, **kwargs):
+    """
+    Return the result of func, its wall time in seconds and the peak
+    memory allocated while it ran in MB (NaN if not traced). Tracing
+    slows down pure python loops, so timings without it are more precise.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    init_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - init_time
+    peak = float('nan')
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak /= 1024**2
+    return result, elapsed, peak
+
+
+def conductivity(config, atoms, ph3):
+    """
+    process_phono3py_conductivity of one structure, which reports a
+    failed solve instead of raising it.
+    """
+    if process_phono3py_conductivity(config, [atoms], [ph3]):
+        raise RuntimeError('conductivity failed, see stderr')
+
+
+def make_config(workdir, atoms, q_points):
+    input_path = f'{workdir}/input.extxyz'
+    write(input_path, atoms)
+    calc_path = f'{workdir}/calc_emt.py'
+    with open(calc_path, 'w') as f:
+        f.write(EMT_SCRIPT)
+
+    config = {
+        'data': {'input_path': input_path, 'save_cond': f'{workdir}/cond'},
+        'calculator': {'calc_type': 'custom', 'path': calc_path},
+        'relax': {},
+        'force_constant': {'fc3_type': 'phonopy'},
+        'conductivity': {
+            'solver_type': 'phonopy',
+            'q_points': q_points,
+            'temperature': 300,
+        },
+    }
+    return parse_config(config)
+
+
+def benchmark_size(
+    config, atoms, size, nneigh, stages, workdir, trace_memory=True
+):
+    """
+    Run the selected stages on a size x size x size supercell of atoms.
+    Return a list of (stage, wall time, peak memory) tuples. Stages that
+    raise are reported on stderr and left out.
+    """
+    timings = []
+
+    def run(stage, func, *args, **kwargs):
+        if stage not in stages:
+            return None
+        try:
+            result, elapsed, peak = measure(
+                func, *args, trace_memory=trace_memory, **kwargs
+            )
+        except Exception as e:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            sys.stderr.write(f'{stage} failed at size {size}: {e}\n')
+            return None
+        timings.append((stage, elapsed, peak))
+        return result
+
+    # thirdorder stages depend on each other, so they always run
+    poscar = from_atoms(atoms)
+    sposcar = run('gen_SPOSCAR', gen_SPOSCAR, poscar, size, size, size)
+    if sposcar is None:
+        sposcar = gen_SPOSCAR(poscar, size, size, size)
+    dists = run('calc_dists', calc_dists, sposcar)
+    if dists is None:
+        dists = calc_dists(sposcar)
+    dmin, nequi, shifts = dists
+    frange = calc_frange(poscar, sposcar, nneigh, dmin)
+
+    if {'build_list4', 'reconstruct_ifcs', 'write_ifcs'} & set(stages):
+        symops = thirdorder_core.SymmetryOperations(
+            poscar['lattvec'], poscar['types'], poscar['positions'].T, SYMPREC)
+        wedge = thirdorder_core.Wedge(
+            poscar, sposcar, symops, dmin, nequi, shifts, frange
+        )
+        list4 = run('build_list4', wedge.build_list4)
+        if list4 is None:
+            list4 = wedge.build_list4()
+
+        # the reconstruction cost does not depend on the force values
+        ntot = len(sposcar['types'])
+        rng = np.random.default_rng(0)
+        phipart = rng.standard_normal((3, len(list4), ntot))
+        phifull = run(
+            'reconstruct_ifcs', thirdorder_core.reconstruct_ifcs,
+            phipart, wedge, list4, poscar, sposcar,
+        )
+        if phifull is None and 'write_ifcs' in stages:
+            phifull = thirdorder_core.reconstruct_ifcs(
+                phipart, wedge, list4, poscar, sposcar
+            )
+        run(
+            'write_ifcs', write_ifcs, phifull, poscar, sposcar, dmin, nequi,
+            shifts, frange, f'{workdir}/FORCE_CONSTANTS_3RD',
+        )
+
+    fc_stages = {'calculate_fc2', 'calculate_fc3_phono3py', 'conductivity'}
+    if fc_stages & set(stages):
+        calc = calc_from_config(config)
+        ph3 = Phono3py(
+            unitcell=aseatoms2phonoatoms(atoms),
+            supercell_matrix=np.diag([size] * 3),
+            phonon_supercell_matrix=np.diag([size] * 3),
+            symprec=1e-5,
+        )
+        ph3.generate_displacements(
+            distance=config['force_constant']['displacement'],
+            cutoff_pair_distance=frange * 10,  # nm to Ang
+        )
+        run('calculate_fc2', calculate_fc2, ph3, calc, False)
+        if ph3.fc2 is None:
+            calculate_fc2(ph3, calc, False)
+        run('calculate_fc3_phono3py', calculate_fc3_phono3py, ph3, calc, True)
+        if 'conductivity' in stages:
+            if ph3.fc3 is None:
+                calculate_fc3_phono3py(ph3, calc, True)
+            run('conductivity', conductivity, config, atoms, ph3)
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark pyte stages on EMT crystals of increasing size'
+    )
+    parser.add_argument(
+        '--element', default='Cu', help='fcc element supported by ase EMT'
+    )
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[2, 3, 4],
+        help='supercell multiplicities of the primitive cell',
+    )
+    parser.add_argument(
+        '--stages', nargs='+', default=STAGES, choices=STAGES,
+        help='stages to benchmark',
+    )
+    parser.add_argument(
+        '--neighbors', type=int, default=3,
+        help='fc3 cutoff given as n-th nearest neighbors',
+    )
+    parser.add_argument(
+        '--q-points', type=float, default=5,
+        help='q-point density for the conductivity stage',
+    )
+    parser.add_argument(
+        '--no-memory', action='store_true',
+        help='do not trace peak memory, for more precise timings',
+    )
+    parser.add_argument('--output', default=None, help='write results to csv')
+    args = parser.parse_args()
+
+    atoms = bulk(args.element, 'fcc')
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        logger = Logger(f'{workdir}/log.pyte')
+        logger.init_recorder(1)
+        config = make_config(workdir, atoms, args.q_points)
+
+        print(f'{"stage":<24}{"natoms":>8}{"time (s)":>12}{"peak (MB)":>12}')
+        for size in args.sizes:
+            natoms = len(atoms) * size**3
+            for stage, elapsed, peak in benchmark_size(
+                config, atoms, size, args.neighbors, args.stages, workdir,
+                trace_memory=not args.no_memory,
+            ):
+                print(f'{stage:<24}{natoms:>8}{elapsed:>12.3f}{peak:>12.1f}')
+                sys.stdout.flush()
+                rows.append([stage, size, natoms, elapsed, peak])
+        logger.fp.close()
+
+    if args.output is not None:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage', 'size', 'natoms', 'time', 'peak_mb'])
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,27 @@
 import os
 import sys
+import time
+from itertools import islice
 from tqdm import tqdm
 import warnings
 import yaml
 
-from ase.io import read, write
+from ase.io import read, iread, write
 
-from pyte.util.calc import calc_from_config
-from pyte.util.relax import aar_from_config
-from pyte.util.phonopy_utils import wrap_atoms, rotate_atoms, get_spgnum
+from pyte.util.calc import (
+    calc_from_config,
+    profile_calculator,
+    ParallelCalculator,
+)
+from pyte.util.relax import aar_from_config, BatchAseAtomRelax
+from pyte.util.phonopy_utils import (
+    wrap_atoms,
+    rotate_atoms,
+    get_spgnum,
+    find_duplicates,
+)
 from pyte.util.logger import Logger, LOG_ORDER
+from pyte.util.checkpoint import Checkpoint
 from pyte.scripts.parse_input import parse_config
 from pyte.scripts.process_fcs import process_fcs_for_ph3
 from pyte.scripts.process_conductivity import (
@@ -18,19 +30,59 @@ from pyte.scripts.process_conductivity import (
 )
 
 
-def relax_atoms_list(config, atoms_list, calc):
+def relax_atoms_list(config, atoms_list, calc, checkpoint=None, offset=0):
     logger = Logger()
+    logger.recorder.start_stage()
+    relaxed_atoms_list = [None] * len(atoms_list)
+    if checkpoint is not None:
+        chunk = range(offset, offset + len(atoms_list))
+        if any(checkpoint.is_done(idx, 'relax') for idx in chunk):
+            for idx, atoms in checkpoint.load_relaxed(chunk).items():
+                relaxed_atoms_list[idx - offset] = atoms
+                checkpoint.restore_record(logger.recorder, idx, 'relax')
+
+    indices = [
+        idx for idx, atoms in enumerate(relaxed_atoms_list, start=offset)
+        if atoms is None
+    ]
+    if not indices:
+        return relaxed_atoms_list
+
     ase_atom_relaxer = aar_from_config(config, calc)
-    relaxed_atoms_list = []
-    for idx, atoms in enumerate(tqdm(atoms_list, desc='atom relax')):
-        logger.log_progress_bar(idx, len(atoms_list), 'atom relax')
+    for idx in indices:
+        atoms = atoms_list[idx - offset]
         logger.recorder.update_recorder(
             idx, 'Formula', atoms.get_chemical_formula(empirical=True)
         )
-        atoms.info['init_spg_num'] = init_spg = get_spgnum(atoms)
+        atoms.info['init_spg_num'] = get_spgnum(atoms)
 
-        atoms, conv = ase_atom_relaxer.relax_atoms(atoms)
+    todo_list = [atoms_list[idx - offset] for idx in indices]
+    if isinstance(ase_atom_relaxer, BatchAseAtomRelax):
+        logger.log_progress_bar(0, len(todo_list), 'atom relax')
+        relaxed_list = ase_atom_relaxer.relax_atoms_list(
+            todo_list, desc='atom relax'
+        )
+        stats_list = ase_atom_relaxer.stats
+    else:
+        relaxed_list, stats_list = [], []
+        profile = getattr(calc, 'profile', None)
+        for count, atoms in enumerate(tqdm(todo_list, desc='atom relax')):
+            logger.log_progress_bar(count, len(todo_list), 'atom relax')
+            init_profile = dict(profile) if profile is not None else None
+            init_time = time.time()
+            relaxed_list.append(ase_atom_relaxer.relax_atoms(atoms))
+            stats = {'wall_time': time.time() - init_time}
+            if profile is not None:
+                stats.update({k: profile[k] - init_profile[k] for k in profile})
+            stats_list.append(stats)
+    logger.finalize_progress_bar()
+
+    for idx, stats in zip(indices, stats_list):
+        logger.recorder.record_profile(idx, 'relax', **stats)
+
+    for idx, (atoms, conv) in zip(indices, relaxed_list):
         atoms.calc = None
+        init_spg = atoms.info['init_spg_num']
         spg_num = atoms.info['spg_num'] = get_spgnum(atoms)
         spg_same = spg_num == init_spg
 
@@ -47,12 +99,57 @@ def relax_atoms_list(config, atoms_list, calc):
             warnings.warn(
                 f'{idx}-th structure {atoms} did not converged with in {step} steps!'
             )
-        relaxed_atoms_list.append(atoms)
-    logger.finalize_progress_bar()
+        relaxed_atoms_list[idx - offset] = atoms
+        if checkpoint is not None:
+            checkpoint.save_relaxed(
+                idx, atoms, logger.recorder.result_dicts[idx]
+            )
 
     return relaxed_atoms_list
 
 
+def process_atoms_list(config, atoms_list, calc, checkpoint=None, offset=0):
+    """
+    Run all stages on atoms_list, whose first structure has global index
+    offset. Phono3py objects are released once their outputs are written.
+    """
+    if config['relax']['relaxed_input_path'] is None:
+        relaxed_atoms_list = relax_atoms_list(
+            config, atoms_list, calc, checkpoint, offset
+        )
+    else:
+        relaxed_atoms_list = atoms_list
+
+    # rotate, wrap ions pass pbc while relaxing (to avoid bug in thirdorder.py)
+    relaxed_atoms_list = [
+        wrap_atoms(rotate_atoms(atoms)) for atoms in relaxed_atoms_list
+    ]
+
+    if relax_path := config['data']['save_relax']:
+        write(relax_path, relaxed_atoms_list, append=offset > 0)
+
+    dup_of = None
+    if config['force_constant']['dedup']:
+        dup_of = [
+            offset + rep for rep in find_duplicates(
+                relaxed_atoms_list, tol=config['force_constant']['dedup_tol']
+            )
+        ]
+
+    ph3_list = process_fcs_for_ph3(
+        config, relaxed_atoms_list, calc, checkpoint, offset, dup_of
+    )
+
+    if config['conductivity']['solver_type'].lower() == 'shengbte':
+        process_shengbte_control(
+            config, relaxed_atoms_list, ph3_list, checkpoint, offset, dup_of
+        )
+    else:
+        process_phono3py_conductivity(
+            config, relaxed_atoms_list, ph3_list, checkpoint, offset, dup_of
+        )
+
+
 def main():
     logger = Logger('log.pyte')
     logger.greetings()
@@ -72,31 +169,45 @@ def main():
         logger.writeline('')
 
     calc = calc_from_config(config)
+    if hasattr(calc, 'calculate'):
+        profile_calculator(calc)
+    checkpoint = None
+    if ckpt_path := config['data']['checkpoint']:
+        checkpoint = Checkpoint(ckpt_path)
+        logger.writeline(f'Resuming from checkpoint {ckpt_path} if possible.')
+
     if config['relax']['relaxed_input_path'] is None:
+        input_path = config['data']['input_path']
         ase_read_kwargs = config['data']['input_args']
-        input_atoms_list = read(config['data']['input_path'], **ase_read_kwargs)
-        logger.init_recorder(len(input_atoms_list))
-        relaxed_atoms_list = relax_atoms_list(config, input_atoms_list, calc)
-
     else:
-        relaxed_atoms_list = read(config['relax']['relaxed_input_path'], ':')
-        logger.init_recorder(len(relaxed_atoms_list))
+        input_path = config['relax']['relaxed_input_path']
+        ase_read_kwargs = {'index': ':'}
 
-    # rotate, wrap ions pass pbc while relaxing (to avoid bug in thirdorder.py)
-    relaxed_atoms_list = [
-        wrap_atoms(rotate_atoms(atoms)) for atoms in relaxed_atoms_list
-    ]
-
-    if relax_path := config['data']['save_relax']:
-        write(relax_path, relaxed_atoms_list)
-
-    ph3_list = process_fcs_for_ph3(config, relaxed_atoms_list, calc)
+    if (stream_size := config['data']['stream_size']) is None:
+        atoms_list = read(input_path, **ase_read_kwargs)
+        logger.init_recorder(len(atoms_list))
+        process_atoms_list(config, atoms_list, calc, checkpoint)
 
-    if config['conductivity']['solver_type'].lower() == 'shengbte':
-        process_shengbte_control(config, relaxed_atoms_list, ph3_list)
     else:
-        process_phono3py_conductivity(config, relaxed_atoms_list, ph3_list)
-
+        logger.writeline(f'Streaming {input_path} in chunks of {stream_size}.')
+        logger.init_recorder(0)
+        atoms_iter = iread(input_path, **ase_read_kwargs)
+        offset = 0
+        while atoms_list := list(islice(atoms_iter, stream_size)):
+            logger.writeline(
+                f'Structures {offset} to {offset + len(atoms_list) - 1}'
+            )
+            process_atoms_list(config, atoms_list, calc, checkpoint, offset)
+            offset += len(atoms_list)
+
+    if checkpoint is not None:
+        checkpoint.close()
+    if isinstance(calc, ParallelCalculator):
+        calc.close()
+    if hasattr(calc, 'pack_summary'):
+        logger.writeline(f'Batch packing: {calc.pack_summary()}')
+    if profile_path := config['data']['save_profile']:
+        logger.save_profile(profile_path)
     logger.log_results()
     logger.log_terminate()
 
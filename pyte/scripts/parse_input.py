@@ -13,6 +13,9 @@ DEFAULT_DATA_CONFIG = {
     'save_fc3': False,
     'save_cond': False,
     'save_control': False,
+    'checkpoint': False,
+    'stream_size': None,
+    'save_profile': False,
 }
 
 
@@ -22,6 +25,12 @@ DEFAULT_CALC_CONFIG = {
     'calc_args': {},
     'batch_size': None,
     'avg_atom_num': None,
+    'max_edges': None,
+    'graph_workers': 0,
+    'nl_skin': None,
+    'cache_path': None,
+    'cache_size': None,
+    'num_workers': 0,
 }
 
 
@@ -32,6 +41,8 @@ DEFAULT_RELAX_CONFIG = {
     'opt': 'fire',
     'cell_filter': 'frechet',
     'fix_symm': True,
+    'batch_relax': False,
+    'batch_structures': None,
     'log': '-',
 }
 
@@ -41,12 +52,21 @@ DEFAULT_FC_CONFIG = {
     'fc2_supercell': 25.,
     'fc3_supercell': 15.,
     'fc2_type': 'phonopy',
+    'hessian_block': 64,
     'fc3_type': 'shengbte',
     'fc3_cutoff': 10000000,
+    'lsq_snapshots': None,
+    'lsq_damp': 1e-3,
     'symmetrize_fc2': False,  # phonopy default
     'symmetrize_fc3': True,
     'load_fc2': None,
     'load_fc3': None,
+    'num_workers': 0,
+    'batch_structures': 1,
+    'dedup': False,
+    'dedup_tol': 1e-3,
+    'stability_q_points': None,
+    'skip_unstable': False,
 }
 
 
@@ -57,6 +77,12 @@ DEFAULT_COND_CONFIG = {
     'temperature': 300,
     'is_isotope': True,
     'convergence': False,
+    'q_points_sweep': None,
+    'sweep_tol': None,
+    'num_workers': 0,
+    'omp_threads': None,
+    'output_format': 'csv',
+    'save_mode_data': False,
 }
 
 
@@ -90,12 +116,31 @@ def _islistinstance(inps, insts):
     return all([_isinstance_in_list(inp, insts) for inp in inps])
 
 
+def check_data_config(config):
+    config_data = config['data']
+    assert _isinstance_in_list(config_data['stream_size'], [int, type(None)])
+    if config_data['stream_size'] is not None:
+        assert config_data['stream_size'] > 0
+    assert _isinstance_in_list(config_data['save_profile'], [str, bool])
+
+
 def check_calc_config(config):
     config_calc = config['calculator']
     assert config_calc['calc_type'].lower() in ['sevennet', 'sevennet-batch', 'custom']
     assert isinstance(config_calc['path'], str)
     assert _isinstance_in_list(config_calc['batch_size'], [int, type(None)])
     assert _isinstance_in_list(config_calc['avg_atom_num'], [int, type(None)])
+    assert _isinstance_in_list(config_calc['max_edges'], [int, type(None)])
+    assert isinstance(config_calc['graph_workers'], int)
+    assert config_calc['graph_workers'] >= 0
+    assert _isinstance_in_list(config_calc['nl_skin'], [float, int, type(None)])
+    assert _isinstance_in_list(config_calc['cache_path'], [str, type(None)])
+    assert _isinstance_in_list(config_calc['cache_size'], [float, int, type(None)])
+    assert isinstance(config_calc['num_workers'], int)
+    assert config_calc['num_workers'] >= 0
+    if config_calc['num_workers'] > 0:
+        # batch calculators already use the device efficiently
+        assert config_calc['calc_type'].lower() in ['sevennet', 'custom']
 
 
 def check_relax_config(config):
@@ -111,6 +156,10 @@ def check_relax_config(config):
     assert config_relax['opt'].lower() in ['lbfgs', 'fire']
     assert config_relax['cell_filter'].lower() in ['unitcell', 'frechet']
     assert isinstance(config_relax['fix_symm'], bool)
+    assert isinstance(config_relax['batch_relax'], bool)
+    assert _isinstance_in_list(config_relax['batch_structures'], [int, type(None)])
+    if config_relax['batch_structures'] is not None:
+        assert config_relax['batch_structures'] > 0
     assert isinstance(config_relax['log'], str)
 
 
@@ -133,7 +182,7 @@ def check_fc_config(config):
     if (load_fc3 := config_fc['load_fc3']) is not None:
         os.makedirs(load_fc3, exist_ok=True)
 #        assert os.path.isdir(load_fc3)
-        assert config_fc['fc3_type'].lower() == 'phonopy'
+        assert config_fc['fc3_type'].lower() in ['phonopy', 'lsq']
         pass_fc3 = True
 
     else:
@@ -146,8 +195,38 @@ def check_fc_config(config):
     if not(pass_fc2 and pass_fc3):
         assert isinstance(config_fc['displacement'], float)
 
-    assert config_fc['fc2_type'].lower() == 'phonopy'
-    assert config_fc['fc3_type'].lower() in ['phonopy', 'shengbte']
+    if config['data']['checkpoint']:
+        # finished force constants are read back from these directories
+        assert config['data']['save_fc2']
+        assert config['data']['save_fc3']
+
+    assert config_fc['fc2_type'].lower() in ['phonopy', 'hessian']
+    if config_fc['fc2_type'].lower() == 'hessian':
+        # needs the model itself, not a calculator in another process
+        assert config['calculator']['calc_type'].lower() in [
+            'sevennet', 'sevennet-batch'
+        ]
+        assert config['calculator']['num_workers'] == 0
+        assert config_fc['num_workers'] == 0
+        assert isinstance(config_fc['hessian_block'], int)
+        assert config_fc['hessian_block'] > 0
+    assert isinstance(config_fc['num_workers'], int)
+    assert config_fc['num_workers'] >= 0
+    assert isinstance(config_fc['batch_structures'], int)
+    assert config_fc['batch_structures'] > 0
+    assert isinstance(config_fc['dedup'], bool)
+    assert isinstance(config_fc['dedup_tol'], float)
+    assert (
+        _isinstance_in_list(config_fc['stability_q_points'], [float, int, type(None)])
+        or _islistinstance(config_fc['stability_q_points'], [int])
+    )
+    assert isinstance(config_fc['skip_unstable'], bool)
+    if config_fc['skip_unstable']:
+        assert config_fc['stability_q_points'] is not None
+    assert config_fc['fc3_type'].lower() in ['phonopy', 'shengbte', 'lsq']
+    if config_fc['fc3_type'].lower() == 'lsq':
+        assert _isinstance_in_list(config_fc['lsq_snapshots'], [int, type(None)])
+        assert _isinstance_in_list(config_fc['lsq_damp'], [float, int])
 
     if not pass_fc3:
         if _isinstance_in_list(config_fc['fc3_cutoff'], [float, int]):
@@ -182,9 +261,31 @@ def check_cond_config(config):
     )
     assert isinstance(config_cond['is_isotope'], bool)
 
+    if (sweep := config_cond['q_points_sweep']) is not None:
+        assert solver_type == 'phonopy'
+        assert isinstance(sweep, list) and len(sweep) > 0
+        for density in sweep:
+            assert (
+                _isinstance_in_list(density, [float, int])
+                or _islistinstance(density, [float, int])
+            )
+    assert _isinstance_in_list(config_cond['sweep_tol'], [float, type(None)])
+
+    assert isinstance(config_cond['num_workers'], int)
+    assert config_cond['num_workers'] >= 0
+    if config_cond['num_workers'] > 0:
+        assert solver_type == 'phonopy'
+    assert _isinstance_in_list(config_cond['omp_threads'], [int, type(None)])
+
+    assert config_cond['output_format'].lower() in ['csv', 'hdf5']
+    assert isinstance(config_cond['save_mode_data'], bool)
+    if config_cond['save_mode_data']:
+        assert config_cond['output_format'].lower() == 'hdf5'
+
 
 def parse_config(config):
     config = update_config_with_defaults(config)
+    check_data_config(config)
     check_calc_config(config)
     check_relax_config(config)
     check_fc_config(config)
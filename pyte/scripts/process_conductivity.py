@@ -1,10 +1,23 @@
+import multiprocessing as mp
 import os
 import sys
+import time
+from collections import deque
+from functools import partial
 from tqdm import tqdm
 import warnings
 
+import numpy as np
+
+from phono3py import Phono3py
+
 from pyte.util.logger import Logger
-from pyte.util.phonopy_utils import get_mesh, check_imaginary_freqs
+from pyte.util.kappa_io import open_kappa_writer, get_mode_data
+from pyte.util.phonopy_utils import (
+    get_mesh,
+    check_imaginary_freqs,
+    aseatoms2phonoatoms,
+)
 
 
 def _get_mesh_from_config(atoms, config):
@@ -19,6 +32,16 @@ def _get_mesh_from_config(atoms, config):
     return mesh
 
 
+def _get_sweep_meshes(atoms, config):
+    """Distinct meshes of q_points_sweep, in the given order."""
+    meshes = []
+    for density in config['conductivity']['q_points_sweep']:
+        mesh = get_mesh(density, atoms.get_cell())
+        if mesh not in meshes:
+            meshes.append(mesh)
+    return meshes
+
+
 def write_shengbte_control(ph3, atoms, config, filename):
     fp = open(filename, 'w')
     fp.write('&allocations\n')
@@ -77,13 +100,42 @@ def write_shengbte_control(ph3, atoms, config, filename):
     fp.close()
 
 
-def process_shengbte_control(config, relaxed_atoms_list, ph3_list):
-    # TODO: check imaginary mode with phonopy?
+def _is_skipped(config, idx):
+    """Whether fc3 of idx-th structure was skipped as unstable."""
+    return bool(
+        config['force_constant']['skip_unstable']
+        and Logger().recorder.result_dicts[idx].get('FC2_imag')
+    )
+
+
+def process_shengbte_control(
+    config, relaxed_atoms_list, ph3_list, checkpoint=None, offset=0, dup_of=None
+):
+    """
+    Write CONTROL_{idx} for each structure. Duplicates in dup_of get the
+    FORCE_CONSTANTS files of their representative, so their CONTROL is
+    written from the relaxed atoms of the representative to match them.
+    """
     logger = Logger()
+    logger.recorder.start_stage()
     ctrl_path = config['data']['save_control']
     os.makedirs(ctrl_path, exist_ok=True)
 
-    for idx, (ph3, atoms) in enumerate(zip(ph3_list, relaxed_atoms_list)):
+    for idx, (ph3, atoms) in enumerate(
+        zip(ph3_list, relaxed_atoms_list), start=offset
+    ):
+        if checkpoint is not None and checkpoint.is_done(idx, 'conductivity'):
+            checkpoint.restore_record(logger.recorder, idx, 'conductivity')
+            continue
+        if _is_skipped(config, idx):
+            ph3_list[idx - offset] = None
+            continue
+        if ph3 is None:
+            # force constants failed, see FC_calc_error
+            continue
+        init_time = time.time()
+        if dup_of is not None:
+            atoms = relaxed_atoms_list[dup_of[idx - offset] - offset]
         mesh = _get_mesh_from_config(atoms, config)
         logger.recorder.update_recorder(
             idx, 'Q_mesh', f'[{",".join(map(str, mesh))}]'
@@ -94,20 +146,217 @@ def process_shengbte_control(config, relaxed_atoms_list, ph3_list):
             config,
             filename=f'{ctrl_path}/CONTROL_{idx}'
         )
+        logger.recorder.record_profile(idx, 'cond', time.time() - init_time)
+        ph3_list[idx - offset] = None
+        if checkpoint is not None:
+            # CONTROL is only useful together with both force constants
+            done = checkpoint.is_done(idx, 'fc2') and checkpoint.is_done(idx, 'fc3')
+            checkpoint.mark(
+                idx, 'conductivity', done, logger.recorder.result_dicts[idx]
+            )
 
 
-def postprocess_kappa_to_csv(file, idx, temps, kappas):
-    for temp, kappa in zip(temps, kappas):
-        if kappa is None:
-            kappa_join = 'NaN'
+KAPPA_KEYS = ['kappa', 'kappa_TOT_RTA', 'kappa_P_RTA', 'kappa_C']
+
+
+def run_phono3py_conductivity(ph3, mesh, temperatures, config, conductivity_type):
+    """
+    Run conductivity of ph3 on mesh. Calling this again with another
+    mesh reuses the force constants and symmetry already set up in ph3.
+    Returns the kappa arrays and whether imaginary modes were found.
+    """
+    ph3.mesh_numbers = mesh
+    ph3.init_phph_interaction(symmetrize_fc3q=False)
+    ph3.run_phonon_solver()
+    freqs, eigvecs, grid = ph3.get_phonon_data()
+    has_imag = check_imaginary_freqs(freqs)
+
+    ph3.run_thermal_conductivity(
+        temperatures=temperatures,
+        is_isotope=config['conductivity']['is_isotope'],
+        conductivity_type=conductivity_type,
+        boundary_mfp=1e6,  # kSRME
+    )
+    cond = ph3.thermal_conductivity
+    cond_dict = {k: getattr(cond, k) for k in KAPPA_KEYS if hasattr(cond, k)}
+    return cond_dict, has_imag
+
+
+def _kappa_change(kappa, prev_kappa):
+    """Maximum relative change of diagonal kappa over temperatures."""
+    kappa = np.asarray(kappa, dtype=float).reshape((-1, 6))[:, :3]
+    prev_kappa = np.asarray(prev_kappa, dtype=float).reshape((-1, 6))[:, :3]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = np.abs(kappa - prev_kappa) / np.abs(prev_kappa)
+    return float(np.nanmax(change)) if np.any(np.isfinite(change)) else np.nan
+
+
+def solve_conductivity(ph3, atoms, idx, config, temperatures, conductivity_type):
+    """
+    Conductivity of idx-th structure, running the q_points_sweep meshes if
+    given. Returns a dict with the kappa arrays, the last mesh, whether
+    imaginary modes were found, success, the kappa_convergence.csv rows
+    without the leading index and mode data if save_mode_data is set. Errors are reported, not raised, and the logger is not used,
+    so this can run in worker processes.
+    """
+    sweep = config['conductivity']['q_points_sweep'] is not None
+    sweep_tol = config['conductivity']['sweep_tol']
+    total_key = 'kappa_TOT_RTA' if conductivity_type == 'wigner' else 'kappa'
+    if sweep:
+        meshes = _get_sweep_meshes(atoms, config)
+    else:
+        meshes = [_get_mesh_from_config(atoms, config)]
+
+    conv_rows = []
+    prev_kappa = None
+    for mesh in meshes:
+        try:
+            cond_dict, has_imag = run_phono3py_conductivity(
+                ph3, mesh, temperatures, config, conductivity_type
+            )
+            success = True
+        except Exception as e:
+            sys.stderr.write(f'Conductivity error in {idx}: {e}\n')
+            nones = [None for _ in temperatures]
+            cond_dict = {key: nones for key in KAPPA_KEYS}
+            has_imag = None
+            success = False
+            break
+
+        if not sweep:
+            break
+        kappa = cond_dict[total_key]
+        change = np.nan if prev_kappa is None else _kappa_change(kappa, prev_kappa)
+        mesh_join = ','.join(map(str, mesh))
+        conv_rows += [
+            f'{mesh_join},{temp},{",".join(map(str, k))},{change}\n'
+            for temp, k in zip(temperatures, np.asarray(kappa).reshape((-1, 6)))
+        ]
+        if sweep_tol is not None and change < sweep_tol:
+            break
+        prev_kappa = kappa
+
+    mode_data = None
+    if success and config['conductivity']['save_mode_data']:
+        mode_data = get_mode_data(ph3.thermal_conductivity, conductivity_type)
+
+    return {
+        'cond_dict': cond_dict,
+        'mesh': mesh,
+        'has_imag': has_imag,
+        'success': success,
+        'conv_rows': conv_rows,
+        'mode_data': mode_data,
+    }
+
+
+def _solve_conductivity_task(config, temperatures, conductivity_type, item):
+    """
+    Worker side of the process pool. Phono3py is rebuilt from the relaxed
+    structure and its force constants, which pickle much more cheaply
+    than the Phono3py object itself.
+    """
+    idx, atoms, supercell_matrix, phonon_supercell_matrix, fc2, fc3 = item
+    init_time = time.time()
+    ph3 = Phono3py(
+        unitcell=aseatoms2phonoatoms(atoms),
+        supercell_matrix=supercell_matrix,
+        phonon_supercell_matrix=phonon_supercell_matrix,
+        symprec=1e-5,
+    )
+    ph3.fc2 = fc2
+    ph3.fc3 = fc3
+    result = solve_conductivity(
+        ph3, atoms, idx, config, temperatures, conductivity_type
+    )
+    result['wall_time'] = time.time() - init_time
+    return result
+
+
+def _solve_conductivity_serial(todo, config, temperatures, conductivity_type):
+    for idx, atoms, ph3 in todo:
+        init_time = time.time()
+        result = solve_conductivity(
+            ph3, atoms, idx, config, temperatures, conductivity_type
+        )
+        result['wall_time'] = time.time() - init_time
+        yield result
+
+
+def _solve_conductivity_pool(
+    todo, config, temperatures, conductivity_type, release=None,
+):
+    """
+    Solve todo in a spawn process pool and yield results in input order.
+    OMP_NUM_THREADS is set for the workers only, before they start.
+    At most twice as many tasks as workers are submitted ahead of the
+    results, and release(idx) is called once the task of idx is submitted,
+    so that force constants are not all pickled and held at once.
+    """
+    config_cond = config['conductivity']
+    num_workers = config_cond['num_workers']
+    omp_env = os.environ.get('OMP_NUM_THREADS')
+    if config_cond['omp_threads'] is not None:
+        os.environ['OMP_NUM_THREADS'] = str(config_cond['omp_threads'])
+    ctx = mp.get_context('spawn')
+    try:
+        pool = ctx.Pool(num_workers)
+    finally:
+        if omp_env is None:
+            os.environ.pop('OMP_NUM_THREADS', None)
         else:
-            kappa = kappa.reshape(-1)
-            kappa_join = ','.join(map(str,kappa))
-        file.write(f'{idx},{temp},{kappa_join}\n')
+            os.environ['OMP_NUM_THREADS'] = omp_env
+
+    items = (
+        (
+            idx,
+            atoms,
+            ph3.supercell_matrix,
+            ph3.phonon_supercell_matrix,
+            ph3.fc2,
+            ph3.fc3,
+        )
+        for idx, atoms, ph3 in todo
+    )
+    task = partial(
+        _solve_conductivity_task, config, temperatures, conductivity_type
+    )
+    with pool:
+        window = deque()
+        for item in items:
+            window.append(pool.apply_async(task, (item,)))
+            if release is not None:
+                release(item[0])
+            del item
+            if len(window) >= 2 * num_workers:
+                yield window.popleft().get()
+        while window:
+            yield window.popleft().get()
+
+
+def process_phono3py_conductivity(
+    config, relaxed_atoms_list, ph3_list, checkpoint=None, offset=0,
+    dup_of=None,
+):
+    """
+    Calculate conductivities of the structures and write them as csv or
+    hdf5 (output_format). With offset > 0 the structures continue an
+    earlier chunk of the same run, so rows are appended to the existing
+    output files.
 
+    If q_points_sweep is given, meshes are run from first to last on the
+    same Phono3py object and every result is written to
+    kappa_convergence.csv. The sweep stops once kappa changes by less
+    than sweep_tol, and the last mesh run gives the reported kappa.
 
-def process_phono3py_conductivity(config, relaxed_atoms_list, ph3_list):
+    With num_workers > 0, structures are solved in a process pool with
+    omp_threads OpenMP threads each; rows are still written in index order.
+
+    Duplicates given by dup_of reuse the result of their representative.
+    Returns the indices of the structures whose conductivity failed.
+    """
     logger = Logger()
+    logger.recorder.start_stage()
     save_path = config['data']['save_cond']
     os.makedirs(save_path, exist_ok=True)
 
@@ -120,60 +369,137 @@ def process_phono3py_conductivity(config, relaxed_atoms_list, ph3_list):
     else:
         conductivity_type = 'wigner'
 
-    csv_tot = open(f'{save_path}/kappa_total.csv', 'w', buffering=1)
-    csv_tot.write(f'index,temperature,xx,yy,zz,yz,xz,xy\n')
-    if conductivity_type == 'wigner':
-        csv_p = open(f'{save_path}/kappa_p.csv', 'w', buffering=1)
-        csv_p.write(f'index,temperature,xx,yy,zz,yz,xz,xy\n')
-        csv_c = open(f'{save_path}/kappa_c.csv', 'w', buffering=1)
-        csv_c.write(f'index,temperature,xx,yy,zz,yz,xz,xy\n')
-
-    KAPPA_KEYS = ['kappa', 'kappa_TOT_RTA', 'kappa_P_RTA', 'kappa_C']
-    for idx, (ph3, atoms) in tqdm(enumerate(zip(
-        ph3_list, relaxed_atoms_list)), desc='conductivity calculation'
+    writer = open_kappa_writer(
+        config, temperatures, conductivity_type, append=offset > 0
+    )
+    csv_conv = None
+    if config['conductivity']['q_points_sweep'] is not None:
+        csv_conv = open(
+            f'{save_path}/kappa_convergence.csv',
+            'a' if offset else 'w',
+            buffering=1,
+        )
+        if not offset:
+            csv_conv.write(
+                'index,mesh_a,mesh_b,mesh_c,temperature,xx,yy,zz,yz,xz,xy,change\n'
+            )
+
+    done = set()
+    if checkpoint is not None:
+        done = {
+            idx for idx in range(offset, offset + len(relaxed_atoms_list))
+            if checkpoint.is_done(idx, 'conductivity')
+        }
+    if dup_of is None:
+        dup_of = list(range(offset, offset + len(relaxed_atoms_list)))
+    # representatives solved here, whose results are shared
+    shared = {
+        rep for idx, rep in enumerate(dup_of, start=offset)
+        if rep != idx and rep not in done
+    }
+    members = {
+        idx for idx, rep in enumerate(dup_of, start=offset)
+        if rep != idx and rep in shared
+    }
+    skipped = {
+        idx for idx in range(offset, offset + len(relaxed_atoms_list))
+        if idx not in done and _is_skipped(config, idx)
+    }
+    # force constants failed, see FC_calc_error
+    failed = {
+        idx for idx, ph3 in enumerate(ph3_list, start=offset)
+        if ph3 is None and idx not in done
+    }
+    todo = (
+        (idx, atoms, ph3)
+        for idx, (ph3, atoms) in enumerate(
+            zip(ph3_list, relaxed_atoms_list), start=offset
+        )
+        if idx not in done and idx not in members and idx not in skipped
+        and idx not in failed
+    )
+    if config['conductivity']['num_workers'] > 0:
+        def release(idx):
+            ph3_list[idx - offset] = None
+
+        results = _solve_conductivity_pool(
+            todo, config, temperatures, conductivity_type, release
+        )
+    else:
+        results = _solve_conductivity_serial(
+            todo, config, temperatures, conductivity_type
+        )
+
+    shared_results = {}
+    unsolved = []
+    for idx, atoms in tqdm(enumerate(
+        relaxed_atoms_list, start=offset), desc='conductivity calculation'
     ):
         logger.log_progress_bar(
-            idx, len(relaxed_atoms_list), 'conductivity calculation'
+            idx - offset, len(relaxed_atoms_list), 'conductivity calculation'
         )
-        mesh = _get_mesh_from_config(atoms, config)
-        ph3.mesh_numbers = mesh
+        if idx in done:
+            checkpoint.restore_record(logger.recorder, idx, 'conductivity')
+            rows = checkpoint.get(idx, 'conductivity', 'rows')
+            writer.write_rows(idx, rows)
+            if csv_conv is not None:
+                csv_conv.write(''.join(rows.get('kappa_convergence.csv', [])))
+            continue
+
+        if idx in skipped or idx in failed:
+            # unstable at the fc2 screen or no force constants to solve with
+            result = {
+                'cond_dict': {
+                    key: [None for _ in temperatures] for key in KAPPA_KEYS
+                },
+                'mesh': _get_mesh_from_config(atoms, config),
+                'has_imag': True if idx in skipped else None,
+                'success': False,
+                'conv_rows': [],
+                'mode_data': None,
+            }
+        elif idx in members:
+            result = shared_results[dup_of[idx - offset]]
+        else:
+            result = next(results)
+            logger.recorder.record_profile(idx, 'cond', result['wall_time'])
+            if idx in shared:
+                shared_results[idx] = result
+        if not result['success']:
+            unsolved.append(idx)
+        cond_dict = result['cond_dict']
         logger.recorder.update_recorder(
-            idx, 'Q_mesh', f'[{",".join(map(str, mesh))}]'
+            idx, 'Q_mesh', f'[{",".join(map(str, result["mesh"]))}]'
         )
-        try:
-            ph3.init_phph_interaction(symmetrize_fc3q=False)
-            ph3.run_phonon_solver()
-            freqs, eigvecs, grid = ph3.get_phonon_data()
-            has_imag = check_imaginary_freqs(freqs)
-            logger.recorder.update_recorder(idx, 'Imaginary', has_imag)
-            if has_imag:
-                warnings.warn(f'{idx}-th structure {atoms} has imaginary frequencies!')
-
-            ph3.run_thermal_conductivity(
-                temperatures=temperatures,
-                is_isotope=config['conductivity']['is_isotope'],
-                conductivity_type=conductivity_type,
-                boundary_mfp=1e6,  # kSRME
-            )
-            cond = ph3.thermal_conductivity
-            cond_dict = {
-                k: getattr(cond, k) for k in KAPPA_KEYS if hasattr(cond, k)
-            }
-            
-        except Exception as e:
-            sys.stderr.write(f'Conductivity error in {idx}: {e}\n')
-            nones = [None for _ in temperatures]
-            cond_dict = {key: nones for key in KAPPA_KEYS}
+        logger.recorder.update_recorder(idx, 'Imaginary', result['has_imag'])
+        if result['has_imag']:
+            warnings.warn(f'{idx}-th structure {atoms} has imaginary frequencies!')
 
-        total_key = 'kappa_TOT_RTA' if conductivity_type == 'wigner' else 'kappa'
-        postprocess_kappa_to_csv(csv_tot, idx, temperatures, cond_dict[total_key])
-        if conductivity_type == 'wigner':
-            postprocess_kappa_to_csv(
-                csv_p, idx, temperatures, cond_dict['kappa_P_RTA']
+        rows = writer.write(
+            idx,
+            cond_dict,
+            mesh=result['mesh'],
+            success=result['success'],
+            mode_data=result['mode_data'],
+        )
+        if result['conv_rows']:
+            # members share the rows of their representative
+            conv_lines = [f'{idx},{row}' for row in result['conv_rows']]
+            csv_conv.write(''.join(conv_lines))
+            rows['kappa_convergence.csv'] = conv_lines
+        if checkpoint is not None:
+            checkpoint.mark(
+                idx,
+                'conductivity',
+                result['success'],
+                logger.recorder.result_dicts[idx],
+                rows=rows,
             )
-            postprocess_kappa_to_csv(csv_c, idx, temperatures, cond_dict['kappa_C'])
+        # outputs are written, release fc2/fc3 of this structure
+        ph3_list[idx - offset] = None
     logger.finalize_progress_bar()
-    csv_tot.close()
-    if conductivity_type == 'wigner':
-        csv_p.close()
-        csv_c.close()
+    results.close()
+    writer.close()
+    if csv_conv is not None:
+        csv_conv.close()
+    return unsolved
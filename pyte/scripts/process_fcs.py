@@ -1,5 +1,6 @@
 import numpy as np
 import os
+import shutil
 import sys
 from tqdm import tqdm
 
@@ -8,85 +9,131 @@ from ase import Atoms
 from phono3py import Phono3py
 from phono3py import file_IO as ph3_IO
 from phonopy import file_IO as ph_IO
+from phonopy.harmonic.force_constants import symmetrize_force_constants
 
-from pyte.thirdorder.thirdorder_ase import thirdorder_main, from_atoms
+from pyte.thirdorder.thirdorder_ase import thirdorder_steps, from_atoms
 from pyte.thirdorder.thirdorder_common import gen_SPOSCAR, calc_dists, calc_frange
+from pyte.thirdorder.thirdorder_lsq import lsq_fc3_steps
 from pyte.util.logger import Logger
-from pyte.util.calc import SevenNetBatchCalculator, single_point_calculate_list
-from pyte.util.phonopy_utils import aseatoms2phonoatoms, get_supercell_matrix
+from pyte.util.calc import (
+    ForceRequest,
+    HessianRequest,
+    DisplacementScheduler,
+    run_requests,
+)
+from pyte.util.parallel import run_with_calculator_server
+from pyte.util.cache import cache_from_config
+from pyte.util.phonopy_utils import (
+    aseatoms2phonoatoms,
+    get_supercell_matrix,
+    get_mesh,
+    fc2_has_imaginary,
+)
 
 
-def calculate_fc2(ph3, calc, symmetrize_fc2):
+def calculate_fc2_steps(ph3, symmetrize_fc2):
     desc = 'fc2 calculation'
-    forces = []
+    supercells = ph3.phonon_supercells_with_displacements
     nat = len(ph3.phonon_supercell)
-    indices = []
+    rows = []
     atoms_list = []
-    for idx, sc in enumerate(ph3.phonon_supercells_with_displacements):
+    for idx, sc in enumerate(supercells):
         if sc is not None:
             atoms_list.append(Atoms(sc.symbols, cell=sc.cell, positions=sc.positions, pbc=True))
-            indices.append(idx)
-
-    if isinstance(calc, SevenNetBatchCalculator):
-        result = calc.batch_calculate(atoms_list, desc=desc)
-    else:
-        result = single_point_calculate_list(atoms_list, calc, desc=desc)
+            rows.append(idx)
 
-    for idx, sc in enumerate(ph3.phonon_supercells_with_displacements):
-        if sc is not None:
-            atoms = result[indices.index(idx)]
-            f = atoms.get_forces()
-        else:
-            f = np.zeros((nat, 3))
-        forces.append(f)
+    # forces are written in place, rows of skipped supercells stay zero
+    force_set = np.zeros((len(supercells), nat, 3))
+    yield ForceRequest(atoms_list, desc, force_set, rows)
 
-    # append forces
-    force_set = np.array(forces)
     ph3.phonon_forces = force_set
     ph3.produce_fc2(symmetrize_fc2=symmetrize_fc2)
 
     return ph3
 
 
-def calculate_fc3_phono3py(ph3, calc, symmetrize_fc3):
+def calculate_fc2(ph3, calc, symmetrize_fc2):
+    return run_requests(calculate_fc2_steps(ph3, symmetrize_fc2), calc)
+
+
+def calculate_fc2_hessian_steps(ph3, symmetrize_fc2, block_size=64):
+    """fc2 from the Hessian of the pristine fc2 supercell."""
+    sc = ph3.phonon_supercell
+    atoms = Atoms(sc.symbols, cell=sc.cell, positions=sc.positions, pbc=True)
+    fc2 = yield HessianRequest(atoms, 'fc2 hessian', block_size)
+    if symmetrize_fc2:
+        symmetrize_force_constants(fc2)
+    ph3.fc2 = fc2
+
+    return ph3
+
+
+def calculate_fc3_phono3py_steps(ph3, symmetrize_fc3):
     desc = 'fc3 calculation'
-    forces = []
+    supercells = ph3.supercells_with_displacements
     nat = len(ph3.supercell)
-    indices = []
+    rows = []
     atoms_list = []
-    for idx, sc in enumerate(ph3.supercells_with_displacements):
+    for idx, sc in enumerate(supercells):
         if sc is not None:
             atoms_list.append(Atoms(sc.symbols, cell=sc.cell, positions=sc.positions, pbc=True))
-            indices.append(idx)
+            rows.append(idx)
 
-    if isinstance(calc, SevenNetBatchCalculator):
-        result = calc.batch_calculate(atoms_list, desc=desc)
-    else:
-        result = single_point_calculate_list(atoms_list, calc, desc=desc)
+    # forces are written in place, rows of skipped supercells stay zero
+    force_set = np.zeros((len(supercells), nat, 3))
+    yield ForceRequest(atoms_list, desc, force_set, rows)
 
-    for idx, sc in enumerate(ph3.supercells_with_displacements):
-        if sc is not None:
-            atoms = result[indices.index(idx)]
-            f = atoms.get_forces()
-        else:
-            f = np.zeros((nat, 3))
-        forces.append(f)
-
-    # append forces
-    force_set = np.array(forces)
     ph3.forces = force_set
     ph3.produce_fc3(symmetrize_fc3r=symmetrize_fc3)
 
     return ph3
 
 
-def process_fcs_for_ph3(config, relaxed_atoms_list, calc):
-    logger = Logger()
-    ph3_list = []
+def calculate_fc3_phono3py(ph3, calc, symmetrize_fc3):
+    return run_requests(calculate_fc3_phono3py_steps(ph3, symmetrize_fc3), calc)
+
+
+def saved_fc_files(config, idx):
+    """Paths of fc2 and fc3 of idx-th structure in save_fc2/save_fc3."""
+    save_fc2 = config['data']['save_fc2']
+    save_fc3 = config['data']['save_fc3']
+    fc2_file = f'{save_fc2}/FORCE_CONSTANTS_2ND_{idx}'
+    fc3_file = (
+        f'{save_fc3}/fc3_{idx}.hdf5'
+        if config['force_constant']['fc3_type'].lower() in ['phonopy', 'lsq']
+        else f'{save_fc3}/FORCE_CONSTANTS_3RD_{idx}'
+    )
+    return {'fc2': fc2_file, 'fc3': fc3_file}
 
+
+def _save_loaded(config, idx, stage, fc_file):
+    """
+    Copy fc_file, read from load_fc2/load_fc3, to save_fc2/save_fc3 so
+    that a resumed run finds it there. Returns whether it was saved.
+    """
+    if not config['data'][f'save_{stage}']:
+        return False
+    saved = saved_fc_files(config, idx)[stage]
+    if os.path.splitext(saved)[1] != os.path.splitext(fc_file)[1]:
+        return False
+    if not os.path.isfile(saved) or not os.path.samefile(fc_file, saved):
+        shutil.copyfile(fc_file, saved)
+    return True
+
+
+def process_fcs_steps(config, idx, atoms, done=()):
+    """
+    Compute (or load) fc2 and fc3 of the idx-th relaxed structure.
+    Generator yielding ForceRequests for the displaced supercells; returns
+    the Phono3py object, the recorder entries of the structure and which
+    of fc2/fc3 are available on disk. Stages listed in done are read back
+    from save_fc2/save_fc3 instead of being recalculated; a missing
+    load_fc2/load_fc3 file falls back to calculation.
+    """
     config_fc = config['force_constant']
     load_fc2 = config_fc['load_fc2']
     load_fc3 = config_fc['load_fc3']
+    fc2_type = config_fc['fc2_type'].lower()
     fc3_type = config_fc['fc3_type'].lower()
 
     save_fc2 = config['data']['save_fc2']
@@ -94,110 +141,287 @@ def process_fcs_for_ph3(config, relaxed_atoms_list, calc):
 
     symmetrize_fc2 = config_fc['symmetrize_fc2']
     symmetrize_fc3 = config_fc['symmetrize_fc3']
+
+    error = False
+    unit_cell = aseatoms2phonoatoms(atoms)
+    fc2_supercell = (
+        atoms.info[config_fc['fc2_supercell']]
+        if isinstance(config_fc['fc2_supercell'], str)
+        else get_supercell_matrix(config_fc['fc2_supercell'], atoms.get_cell())
+    )
+    fc3_supercell = (
+        atoms.info[config_fc['fc3_supercell']]
+        if isinstance(config_fc['fc3_supercell'], str)
+        else get_supercell_matrix(config_fc['fc3_supercell'], atoms.get_cell())
+    )
+
+    fc2_super_info = f'[{",".join(map(str, np.diagonal(fc2_supercell)))}]'
+    fc3_super_info = f'[{",".join(map(str, np.diagonal(fc3_supercell)))}]'
+
+    ph3 = Phono3py(
+        unitcell=unit_cell,
+        supercell_matrix=fc3_supercell,
+        phonon_supercell_matrix=fc2_supercell,
+        symprec=1e-5,
+    )
+
+    cutoff = config_fc['fc3_cutoff']
+    if isinstance(cutoff, str):
+        cutoff = atoms.info[cutoff]
+    if cutoff < 0 and config_fc['fc3_type'].lower() == 'phonopy':
+        poscar = from_atoms(atoms)
+        sposcar = gen_SPOSCAR(poscar, *np.diag(fc2_supercell))
+        dmin, _, _ = calc_dists(sposcar)
+        cutoff = calc_frange(poscar, sposcar, -cutoff, dmin) * 10  # nm to Ang
+    if cutoff > 0 and config_fc['fc3_type'].lower() in ['shengbte', 'lsq']:
+        cutoff /= 10  # Ang to nm
+    ph3.generate_displacements(
+        distance=config_fc['displacement'],
+        cutoff_pair_distance=cutoff,
+    )
+
+    fc2_file = fc3_file = None
+    if 'fc2' in done:
+        fc2_file = saved_fc_files(config, idx)['fc2']
+    elif load_fc2:
+        fc2_file = f'{load_fc2}/FORCE_CONSTANTS_2ND_{idx}'
+    if 'fc3' in done:
+        fc3_file = saved_fc_files(config, idx)['fc3']
+    elif load_fc3:
+        fc3_file = f'{load_fc3}/fc3_{idx}.hdf5'
+
+    status = {'fc2': False, 'fc3': False}
+    if fc2_file is not None and os.path.isfile(fc2_file):
+        fc2 = ph_IO.parse_FORCE_CONSTANTS(fc2_file)
+        ph3.fc2 = fc2
+        status['fc2'] = 'fc2' in done or _save_loaded(config, idx, 'fc2', fc2_file)
+    else:
+        try:
+            if fc2_type == 'hessian':
+                ph3 = yield from calculate_fc2_hessian_steps(
+                    ph3, symmetrize_fc2, config_fc['hessian_block']
+                )
+            else:
+                ph3 = yield from calculate_fc2_steps(ph3, symmetrize_fc2)
+            if save_fc2:
+                ph_IO.write_FORCE_CONSTANTS(
+                    ph3.fc2,
+                    filename=f'{save_fc2}/FORCE_CONSTANTS_2ND_{idx}',
+                )
+                status['fc2'] = True
+        except Exception as e:
+            sys.stderr.write(f'FC2 calc error at {idx}: {e}\n')
+            error = True
+
+    num_fc2 = 1 if fc2_type == 'hessian' else sum(
+        [1 for sc in ph3.phonon_supercells_with_displacements if sc is not None]
+    )
+
+    # coarse harmonic screen, before the expensive fc3
+    fc2_imag = None
+    q_points = config_fc['stability_q_points']
+    if q_points is not None and ph3.fc2 is not None:
+        mesh = q_points if isinstance(q_points, list) else get_mesh(
+            q_points, atoms.get_cell()
+        )
+        try:
+            fc2_imag = fc2_has_imaginary(ph3, mesh)
+        except Exception as e:
+            sys.stderr.write(f'FC2 stability check error at {idx}: {e}\n')
+
+    num_fc3 = 0
+    if fc2_imag and config_fc['skip_unstable']:
+        sys.stderr.write(f'Skipping FC3 of unstable structure {idx}\n')
+    elif fc3_file is not None and os.path.isfile(fc3_file):
+        # FORCE_CONSTANTS_3RD is only read by ShengBTE
+        if fc3_file.endswith('.hdf5'):
+            fc3 = ph3_IO.read_fc3_from_hdf5(fc3_file)
+            ph3.fc3 = fc3
+        status['fc3'] = 'fc3' in done or _save_loaded(config, idx, 'fc3', fc3_file)
+    elif fc3_type == 'phonopy':
+        try:
+            ph3 = yield from calculate_fc3_phono3py_steps(ph3, symmetrize_fc3)
+            if save_fc3:
+                ph3_IO.write_fc3_to_hdf5(
+                    ph3.fc3,
+                    filename=f'{save_fc3}/fc3_{idx}.hdf5',
+                )
+                status['fc3'] = True
+        except Exception as e:
+            sys.stderr.write(f'FC3 calc error at {idx}: {e}\n')
+            error = True
+
+        num_fc3 = sum(
+            [1 for sc in ph3.supercells_with_displacements if sc is not None]
+        )
+    elif fc3_type == 'lsq':
+        assert np.all(fc3_supercell == np.diag(np.diag(fc3_supercell)))
+        try:
+            num_fc3 = yield from lsq_fc3_steps(
+                ph3,
+                cutoff,
+                atoms,
+                config_fc['displacement'],
+                num_snapshots=config_fc['lsq_snapshots'],
+                damp=config_fc['lsq_damp'],
+            )
+            if save_fc3:
+                ph3_IO.write_fc3_to_hdf5(
+                    ph3.fc3,
+                    filename=f'{save_fc3}/fc3_{idx}.hdf5',
+                    p2s_map=ph3.primitive.p2s_map,
+                )
+                status['fc3'] = True
+        except Exception as e:
+            num_fc3 = 0
+            sys.stderr.write(f'FC3 calc error at {idx}: {e}\n')
+            error = True
+    else:
+        assert np.all(fc3_supercell == np.diag(np.diag(fc3_supercell)))
+        fc3_supercell = np.diag(fc3_supercell)
+        try:
+            num_fc3 = yield from thirdorder_steps(
+                *fc3_supercell,
+                cutoff,
+                atoms,
+                f'{save_fc3}/FORCE_CONSTANTS_3RD_{idx}'
+            )
+            status['fc3'] = True
+        except Exception as e:
+            num_fc3 = 0
+            sys.stderr.write(f'FC3 calc error at {idx}: {e}\n')
+            error = True
+
+    record = {
+        'FC2_super': fc2_super_info+f'*{num_fc2}',
+        'FC3_super': fc3_super_info+f'*{num_fc3}',
+        'FC_calc_error': error,
+        'FC2_imag': fc2_imag,
+    }
+    return ph3, record, status
+
+
+def process_fcs(config, idx, atoms, calc, done=()):
+    return run_requests(process_fcs_steps(config, idx, atoms, done), calc)
+
+
+def _process_fcs_task(config, idx, item, calc):
+    atoms, done = item
+    return process_fcs(config, idx, atoms, calc, done)
+
+
+def process_fcs_for_ph3(
+    config, relaxed_atoms_list, calc, checkpoint=None, offset=0, dup_of=None
+):
+    """
+    Compute force constants of relaxed_atoms_list, whose first structure
+    has index offset. If dup_of is given (global index of the structure
+    each one duplicates, see find_duplicates), duplicates share the
+    Phono3py object, records and saved files of their representative.
+    """
+    logger = Logger()
+    logger.recorder.start_stage()
+    ph3_list = [None] * len(relaxed_atoms_list)
+
+    save_fc2 = config['data']['save_fc2']
+    save_fc3 = config['data']['save_fc3']
     if save_fc2:
         os.makedirs(save_fc2, exist_ok=True)
     if save_fc3:
         os.makedirs(save_fc3, exist_ok=True)
 
-    for idx, atoms in enumerate(tqdm(relaxed_atoms_list, desc='processing fcs')):
-        error = False
-        logger.log_progress_bar(idx, len(relaxed_atoms_list), 'processing fcs')
-        unit_cell = aseatoms2phonoatoms(atoms)
-        fc2_supercell = (
-            atoms.info[config_fc['fc2_supercell']]
-            if isinstance(config_fc['fc2_supercell'], str)
-            else get_supercell_matrix(config_fc['fc2_supercell'], atoms.get_cell())
-        )
-        fc3_supercell = (
-            atoms.info[config_fc['fc3_supercell']]
-            if isinstance(config_fc['fc3_supercell'], str)
-            else get_supercell_matrix(config_fc['fc3_supercell'], atoms.get_cell())
-        )
-
-        fc2_super_info = f'[{",".join(map(str, np.diagonal(fc2_supercell)))}]'
-        fc3_super_info = f'[{",".join(map(str, np.diagonal(fc3_supercell)))}]'
+    tasks, members = [], []
+    task_indices = set()
+    for idx, atoms in enumerate(relaxed_atoms_list, start=offset):
+        done = () if checkpoint is None else checkpoint.done_stages(idx)
+        if 'conductivity' in done:
+            # nothing downstream needs this structure anymore
+            for stage in ['fc2', 'fc3']:
+                checkpoint.restore_record(logger.recorder, idx, stage)
+            continue
+        rep = idx if dup_of is None else dup_of[idx - offset]
+        if rep != idx and rep in task_indices:
+            members.append((idx, rep))
+            continue
+        tasks.append((idx, (atoms, done)))
+        task_indices.add(idx)
 
-        ph3 = Phono3py(
-            unitcell=unit_cell,
-            supercell_matrix=fc3_supercell,
-            phonon_supercell_matrix=fc2_supercell,
-            symprec=1e-5,
+    config_fc = config['force_constant']
+    cache = cache_from_config(config)
+    scheduler = DisplacementScheduler(calc, config_fc['batch_structures'], cache)
+    if (num_workers := config_fc['num_workers']) > 0:
+        results = run_with_calculator_server(
+            _process_fcs_task, (config,), tasks, scheduler, num_workers
         )
-
-        cutoff = config_fc['fc3_cutoff']
-        if isinstance(cutoff, str):
-            cutoff = atoms.info[cutoff]
-        if cutoff < 0 and config_fc['fc3_type'].lower() == 'phonopy':
-            poscar = from_atoms(atoms)
-            sposcar = gen_SPOSCAR(poscar, *np.diag(fc2_supercell))
-            dmin, _, _ = calc_dists(sposcar)
-            cutoff = calc_frange(poscar, sposcar, -cutoff, dmin) * 10  # nm to Ang
-        if cutoff > 0 and config_fc['fc3_type'].lower() == 'shengbte':
-            cutoff /= 10  # Ang to nm
-        ph3.generate_displacements(
-            distance=config_fc['displacement'],
-            cutoff_pair_distance=cutoff,
+    else:
+        results = scheduler.run(
+            (idx, process_fcs_steps(config, idx, atoms, done))
+            for idx, (atoms, done) in tasks
         )
 
-        if load_fc2:
-            fc2 = ph_IO.parse_FORCE_CONSTANTS(f'{load_fc2}/FORCE_CONSTANTS_2ND_{idx}')
-            ph3.fc2 = fc2
+    total = len(tasks)
+    done_dict = dict(tasks)
+    status_dict = {}
+    for count, (idx, result) in enumerate(
+        tqdm(results, total=total, desc='processing fcs')
+    ):
+        logger.log_progress_bar(count, total, 'processing fcs')
+        if isinstance(result, Exception):
+            # the worker of this structure died, go on with the others
+            sys.stderr.write(f'FC calc error at {idx}: {result}\n')
+            logger.writeline(f'Force constants of {idx} failed: {result}')
+            ph3 = None
+            record = {'FC_calc_error': True}
+            status = {'fc2': False, 'fc3': False}
         else:
-            try:
-                ph3 = calculate_fc2(ph3, calc, symmetrize_fc2)
-                if save_fc2:
-                    ph_IO.write_FORCE_CONSTANTS(
-                        ph3.fc2,
-                        filename=f'{save_fc2}/FORCE_CONSTANTS_2ND_{idx}',
-                    )
-            except Exception as e:
-                sys.stderr.write(f'FC2 calc error at {idx}: {e}\n')
-                error = True
-
-        num_fc2 = sum(
-            [1 for sc in ph3.phonon_supercells_with_displacements if sc is not None]
-        )
+            ph3, record, status = result
+        ph3_list[idx - offset] = ph3
+        status_dict[idx] = status
+        for key, val in record.items():
+            logger.recorder.update_recorder(idx, key, val)
+        scheduler.key_stats(idx)  # none if the worker died before any step
+        logger.recorder.record_profile(idx, 'fc', **scheduler.stats.pop(idx))
+        if checkpoint is None:
+            continue
+        for stage in ['fc2', 'fc3']:
+            if stage in done_dict[idx][1]:
+                checkpoint.restore_record(logger.recorder, idx, stage)
+            else:
+                checkpoint.mark(idx, stage, status[stage], record)
+    if total:
+        logger.finalize_progress_bar()
 
-        if load_fc3:
-            fc3 = ph3_IO.read_fc3_from_hdf5(f'{load_fc3}/fc3_{idx}.hdf5')
-            ph3.fc3 = fc3
-        elif fc3_type == 'phonopy':
-            try:
-                ph3 = calculate_fc3_phono3py(ph3, calc, symmetrize_fc3)
-                if save_fc3:
-                    ph3_IO.write_fc3_to_hdf5(
-                        ph3.fc3,
-                        filename=f'{save_fc3}/fc3_{idx}.hdf5',
-                    )
-            except Exception as e:
-                sys.stderr.write(f'FC3 calc error at {idx}: {e}\n')
-                error = True
-
-            num_fc3 = sum(
-                [1 for sc in ph3.supercells_with_displacements if sc is not None]
-            )
-        else:
-            assert np.all(fc3_supercell == np.diag(np.diag(fc3_supercell)))
-            fc3_supercell = np.diag(fc3_supercell)
-            try:
-                num_fc3 = thirdorder_main(
-                    *fc3_supercell,
-                    cutoff,
-                    atoms,
-                    calc,
-                    f'{save_fc3}/FORCE_CONSTANTS_3RD_{idx}'
-                )
-            except Exception as e:
-                num_fc3 = 0
-                sys.stderr.write(f'FC3 calc error at {idx}: {e}\n')
-                error = True
-        ph3_list.append(ph3)
-        logger.recorder.update_recorder(
-            idx, 'FC2_super', fc2_super_info+f'*{num_fc2}'
+    for idx, rep in members:
+        ph3_list[idx - offset] = ph3_list[rep - offset]
+        record = {
+            key: logger.recorder.result_dicts[rep][key]
+            for key in ['FC2_super', 'FC3_super', 'FC_calc_error', 'FC2_imag']
+        }
+        record['Dup_of'] = rep
+        for key, val in record.items():
+            logger.recorder.update_recorder(idx, key, val)
+
+        rep_files = saved_fc_files(config, rep)
+        status = {}
+        for stage, fc_file in saved_fc_files(config, idx).items():
+            status[stage] = status_dict[rep][stage]
+            if status[stage] and os.path.isfile(rep_files[stage]):
+                shutil.copyfile(rep_files[stage], fc_file)
+        if checkpoint is not None:
+            for stage in ['fc2', 'fc3']:
+                checkpoint.mark(idx, stage, status[stage], record)
+    if members:
+        logger.writeline(
+            f'Force constants shared by {len(members)} duplicate structures'
         )
-        logger.recorder.update_recorder(
-            idx, 'FC3_super', fc3_super_info+f'*{num_fc3}'
+
+    logger.writeline(
+        f'Force calculation: {scheduler.num_calculated} supercells, '
+        + f'{scheduler.throughput:.2f} supercells/s'
+    )
+    if cache is not None:
+        logger.writeline(
+            f'Force cache: {cache.hits} hits, {cache.misses} misses, '
+            + f'{cache.size / 1024**2:.1f} MB'
         )
-        logger.recorder.update_recorder(idx, 'FC_calc_error', error)
-    logger.finalize_progress_bar()
-    return  ph3_list 
+    return ph3_list
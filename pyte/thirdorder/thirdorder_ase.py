@@ -27,7 +27,7 @@ except NameError:
     xrange = range
 
 
-from pyte.util.calc import SevenNetBatchCalculator, single_point_calculate_list
+from pyte.util.calc import ForceRequest, run_requests
 import pyte.thirdorder.thirdorder_core as thirdorder_core
 from pyte.thirdorder.thirdorder_common import *
 from ase import Atoms
@@ -99,7 +99,38 @@ def build_unpermutation(sposcar):
     return indices.argsort().tolist()
 
 
-def thirdorder_main(na, nb, nc, cut, relaxed_atoms, calc, fname):
+def displaced_positions(sposcar, list4):
+    """
+    Cartesian positions (Angstrom) of all 4 * len(list4) displaced
+    supercells in normalized atom order, as one (nruns, ntot, 3) array.
+    Run nirred * n + i displaces the pair list4[i] with the n-th sign pair.
+    """
+    nirred = len(list4)
+    indices = np.argsort(build_unpermutation(sposcar))
+    base = (sposcar["lattvec"] @ sposcar["positions"]).T[indices] * 10
+    positions = np.empty((4 * nirred, len(indices), 3))
+    positions[:] = base
+
+    # original atom index -> normalized index
+    p = np.array(build_unpermutation(sposcar))
+    e = np.array(list4, dtype=np.intp).reshape((-1, 4))
+    for n in xrange(4):
+        isign = (-1)**(n // 2)
+        jsign = -(-1)**(n % 2)
+        runs = np.arange(nirred * n, nirred * (n + 1))
+        positions[runs, p[e[:, 1]], e[:, 3]] += isign * H * 10
+        positions[runs, p[e[:, 0]], e[:, 2]] += jsign * H * 10
+    return positions
+
+
+def thirdorder_steps(
+    na, nb, nc, cut, relaxed_atoms, fname, chunk_size=512
+):
+    """
+    Generator version of thirdorder_main: yields ForceRequests for the
+    displaced supercells, chunk_size at a time, and returns the number of
+    calculations.
+    """
     if min(na, nb, nc) < 1:
         raise ValueError("Error: na, nb and nc must be positive integers")
 
@@ -133,35 +164,32 @@ def thirdorder_main(na, nb, nc, cut, relaxed_atoms, calc, fname):
     nirred = len(list4)
     nruns = 4 * nirred
 
-    width = len(str(4 * (len(list4) + 1)))
-    atoms_list = list(range(nirred*3+len(list4)))
-    for i, e in enumerate(list4):
-        for n in xrange(4):
-            isign = (-1)**(n // 2)
-            jsign = -(-1)**(n % 2)
-            number = nirred * n + i
-            dsposcar = normalize_SPOSCAR(
-                move_two_atoms(sposcar, e[1], e[3], isign * H, e[0], e[2],
-                               jsign * H))
-            atoms_list[number] = to_atoms(dsposcar)
+    base = to_atoms(normalize_SPOSCAR(sposcar))
+    positions = displaced_positions(sposcar, list4)
+    # sign of each run in the finite difference, as in the run order above
+    signs = np.repeat([
+        (-1)**(n // 2) * -(-1)**(n % 2) for n in xrange(4)
+    ], nirred)
+    p = build_unpermutation(sposcar)
 
     desc = 'fc3 calculate shengBTE'
-    if isinstance(calc, SevenNetBatchCalculator):
-        atoms_list = calc.batch_calculate(atoms_list, desc=desc)
-    else:
-        atoms_list = single_point_calculate_list(atoms_list, calc, desc=desc)
-    p = build_unpermutation(sposcar)
-    forces = []
-    for atoms in atoms_list:
-        forces.append(read_forces(atoms)[p, :])
-        res = forces[-1].mean(axis=0)
     phipart = np.zeros((3, nirred, ntot))
-    for i, e in enumerate(list4):
-        for n in xrange(4):
-            isign = (-1)**(n // 2)
-            jsign = -(-1)**(n % 2)
-            number = nirred * n + i
-            phipart[:, i, :] -= isign * jsign * forces[number].T
+    for start in xrange(0, nruns, chunk_size):
+        runs = np.arange(start, min(start + chunk_size, nruns))
+        atoms_list = []
+        for number in runs:
+            atoms = base.copy()
+            atoms.positions = positions[number]
+            atoms_list.append(atoms)
+
+        forces = np.empty((len(runs), ntot, 3))
+        yield ForceRequest(atoms_list, desc, forces, range(len(runs)))
+        forces = forces[:, p, :]
+        np.add.at(
+            phipart,
+            (slice(None), runs % nirred),
+            -(signs[runs, None, None] * forces).transpose(2, 0, 1),
+        )
     phipart /= (400. * H * H)
     phifull = thirdorder_core.reconstruct_ifcs(phipart, wedge, list4,
                                                poscar, sposcar)
@@ -176,4 +204,10 @@ def thirdorder_main(na, nb, nc, cut, relaxed_atoms, calc, fname):
         fname,
     )
 
-    return len(atoms_list)
+    return nruns
+
+
+def thirdorder_main(na, nb, nc, cut, relaxed_atoms, calc, fname):
+    return run_requests(
+        thirdorder_steps(na, nb, nc, cut, relaxed_atoms, fname), calc
+    )
@@ -110,43 +110,63 @@ def gen_SPOSCAR(poscar, na, nb, nc):
     nruter["lattvec"][:, 2] *= nc
     nruter["elements"] = copy.copy(poscar["elements"])
     nruter["numbers"] = na * nb * nc * poscar["numbers"]
-    nruter["positions"] = np.empty(
-        (3, poscar["positions"].shape[1] * na * nb * nc))
-    pos = 0
-    for pos, (k, j, i, iat) in enumerate(
-            itertools.product(
-                xrange(nc),
-                xrange(nb), xrange(na), xrange(poscar["positions"].shape[1]))):
-        nruter["positions"][:, pos] = (
-            poscar["positions"][:, iat] + [i, j, k]) / [na, nb, nc]
+    # Order (from most to least significant): k,j,i,iat
+    cells = np.indices((nc, nb, na)).reshape((3, -1))[::-1].T
+    nruter["positions"] = ((
+        poscar["positions"].T[np.newaxis, :, :] + cells[:, np.newaxis, :])
+        / [na, nb, nc]).reshape((-1, 3)).T
     nruter["types"] = []
     for i in xrange(na * nb * nc):
         nruter["types"].extend(poscar["types"])
     return nruter
 
 
-def calc_dists(sposcar):
+def _block_dists(posi, posj, rows):
     """
-    Return the distances between atoms in the supercells, their
-    degeneracies and the associated supercell vectors.
+    Return the minimum squared distances between the atoms in the rows
+    slice and all atoms, and which of the 27 images attain them.
     """
-    ntot = sposcar["positions"].shape[1]
-    posi = np.dot(sposcar["lattvec"], sposcar["positions"])
-    d2s = np.empty((27, ntot, ntot))
-    for j, (ja, jb, jc) in enumerate(
-            itertools.product(xrange(-1, 2), xrange(-1, 2), xrange(-1, 2))):
-        posj = np.dot(sposcar["lattvec"],
-                      (sposcar["positions"].T + [ja, jb, jc]).T)
-        d2s[j, :, :] = scipy.spatial.distance.cdist(posi.T, posj.T,
+    posr = posi[rows]
+    d2s = np.empty((len(posj), posr.shape[0], posj[0].shape[0]))
+    for j, pos in enumerate(posj):
+        d2s[j, :, :] = scipy.spatial.distance.cdist(posr, pos,
                                                     "sqeuclidean")
     d2min = d2s.min(axis=0)
-    dmin = np.sqrt(d2min)
     degenerate = (np.abs(d2s - d2min) < 1e-4)
-    nequi = degenerate.sum(axis=0, dtype=np.intc)
+    return d2min, degenerate
+
+
+def calc_dists(sposcar, blocksize=256):
+    """
+    Return the distances between atoms in the supercells, their
+    degeneracies and the associated supercell vectors.
+
+    Rows are processed in blocks of blocksize atoms so that only a
+    (27, blocksize, ntot) slice of the image distances is kept at a time.
+    """
+    ntot = sposcar["positions"].shape[1]
+    posi = np.dot(sposcar["lattvec"], sposcar["positions"]).T
+    posj = [
+        np.dot(sposcar["lattvec"], (sposcar["positions"].T + [ja, jb, jc]).T).T
+        for ja, jb, jc in itertools.product(
+            xrange(-1, 2), xrange(-1, 2), xrange(-1, 2))
+    ]
+    blocks = [slice(i, i + blocksize) for i in xrange(0, ntot, blocksize)]
+
+    dmin = np.empty((ntot, ntot))
+    nequi = np.empty((ntot, ntot), dtype=np.intc)
+    for rows in blocks:
+        d2min, degenerate = _block_dists(posi, posj, rows)
+        dmin[rows, :] = np.sqrt(d2min)
+        nequi[rows, :] = degenerate.sum(axis=0, dtype=np.intc)
+
+    # The width of shifts is only known after all blocks have been seen.
     maxequi = nequi.max()
-    shifts = np.empty((ntot, ntot, maxequi))
-    sorting = np.argsort(np.logical_not(degenerate), axis=0)
-    shifts = np.transpose(sorting[:maxequi, :, :], (1, 2, 0)).astype(np.intc)
+    shifts = np.empty((ntot, ntot, maxequi), dtype=np.intc)
+    for rows in blocks:
+        _, degenerate = _block_dists(posi, posj, rows)
+        sorting = np.argsort(np.logical_not(degenerate), axis=0)
+        shifts[rows, :, :] = np.transpose(sorting[:maxequi, :, :], (1, 2, 0))
     return (dmin, nequi, shifts)
 
 
@@ -194,64 +214,185 @@ def move_two_atoms(poscar, iat, icoord, ih, jat, jcoord, jh):
     return nruter
 
 
+class SparseIFCs(object):
+    """
+    Anharmonic IFCs stored only for the atom triplets (i, j, k), with i
+    in the first unit cell, that carry nonzero constants. Memory scales
+    with the number of interacting triplets instead of natoms*ntot**2.
+    """
+
+    def __init__(self, triplets, values, natoms, ntot):
+        self.natoms = natoms
+        self.ntot = ntot
+        triplets = np.asarray(triplets).reshape((-1, 3))
+        keys, inverse = np.unique(
+            self._keys(triplets[:, 0], triplets[:, 1], triplets[:, 2]),
+            return_inverse=True)
+        self.keys = keys
+        self.values = np.zeros((keys.size, 3, 3, 3))
+        np.add.at(self.values, inverse.reshape(-1),
+                  np.asarray(values).reshape((-1, 3, 3, 3)))
+
+    def _keys(self, ii, jj, kk):
+        return ((np.asarray(ii, dtype=np.int64) * self.ntot +
+                 np.asarray(jj, dtype=np.int64)) * self.ntot +
+                np.asarray(kk, dtype=np.int64))
+
+    @property
+    def triplets(self):
+        """
+        Return the stored (i, j, k) triplets as an (n, 3) array.
+        """
+        ij, kk = np.divmod(self.keys, self.ntot)
+        ii, jj = np.divmod(ij, self.ntot)
+        return np.stack((ii, jj, kk), axis=1)
+
+    def take(self, ii, jj, kk):
+        """
+        Return the 3x3x3 IFC blocks for the triplets (ii, jj, kk), which
+        may be arrays. Triplets that are not stored are zero.
+        """
+        keys = self._keys(ii, jj, kk)
+        pos = np.minimum(np.searchsorted(self.keys, keys),
+                         max(self.keys.size - 1, 0))
+        nruter = np.zeros(keys.shape + (3, 3, 3))
+        if self.keys.size == 0:
+            return nruter
+        found = self.keys[pos] == keys
+        nruter[found] = self.values[pos[found]]
+        return nruter
+
+    def todense(self):
+        """
+        Return the IFCs as a dense (3, 3, 3, natoms, ntot, ntot) array.
+        """
+        nruter = np.zeros((3, 3, 3, self.natoms, self.ntot, self.ntot))
+        ii, jj, kk = self.triplets.T
+        nruter[:, :, :, ii, jj, kk] = np.transpose(self.values, (1, 2, 3, 0))
+        return nruter
+
+
+def _image_positions(sposcar):
+    """
+    Return the Cartesian coordinates of the 27 periodic images of every
+    atom in the supercell, shaped (ntot, 27, 3). Each is computed with the
+    same np.dot as the original nested loops, so distances round alike.
+    """
+    shifts27 = np.array(
+        list(itertools.product(xrange(-1, 2), xrange(-1, 2), xrange(-1, 2))),
+        dtype=np.double)
+    lattvec = sposcar["lattvec"]
+    positions = sposcar["positions"]
+    ntot = positions.shape[1]
+    nruter = np.empty((ntot, 27, 3))
+    for jj in xrange(ntot):
+        for ishift in xrange(27):
+            nruter[jj, ishift] = np.dot(lattvec,
+                                        shifts27[ishift] + positions[:, jj])
+    return nruter
+
+
+def _select_ifc_blocks(car27, dmin, nequi, shifts, frange, ii, chunksize):
+    """
+    Return the (jj, kk) pairs around atom ii that survive the force
+    cutoff, together with the indices into shifts27 of the periodic
+    images of jj and kk that are closest to each other.
+    """
+    frange2 = frange * frange
+    inside = np.nonzero(dmin[ii, :] < frange)[0]
+    if inside.size == 0:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty, empty, empty
+    nequi_ii = nequi[ii, inside]
+    maxequi = nequi_ii.max()
+    ishifts = shifts[ii, inside, :maxequi]
+    # Cartesian coordinates of all equivalent images of each atom within
+    # range, shape (ninside, maxequi, 3). Padding entries are masked out.
+    car = car27[inside[:, None], ishifts]
+    valid = np.arange(maxequi)[None, :] < nequi_ii[:, None]
+    validk = valid[None, :, None, :]
+
+    jjs, kks, best2s, best3s = [], [], [], []
+    for start in xrange(0, inside.size, chunksize):
+        carj = car[start:start + chunksize]
+        diff = carj[:, None, :, None, :] - car[None, :, None, :, :]
+        # summed in the same order as ((carj - cark)**2).sum()
+        d2 = diff[..., 0]**2 + diff[..., 1]**2 + diff[..., 2]**2
+        d2[~(valid[start:start + chunksize, None, :, None] & validk)] = np.inf
+        # The first minimum along the flattened (shift2, shift3) axis is
+        # the same image pair the nested loops used to pick.
+        d2 = d2.reshape(d2.shape[0], d2.shape[1], -1)
+        best = d2.argmin(axis=-1)
+        d2min = np.take_along_axis(d2, best[..., None], axis=-1)[..., 0]
+        jsel, ksel = np.nonzero(d2min < frange2)
+        best = best[jsel, ksel]
+        jjs.append(inside[start + jsel])
+        kks.append(inside[ksel])
+        best2s.append(ishifts[start + jsel, best // maxequi])
+        best3s.append(ishifts[ksel, best % maxequi])
+    return (np.concatenate(jjs), np.concatenate(kks),
+            np.concatenate(best2s), np.concatenate(best3s))
+
+
 def write_ifcs(phifull, poscar, sposcar, dmin, nequi, shifts, frange,
-               filename):
+               filename, chunksize=64):
     """
     Write out the full anharmonic interatomic force constant matrix,
-    taking the force cutoff into account.
+    stored in a SparseIFCs object, taking the force cutoff into account.
+
+    Candidate triplets are selected with array masks one central atom
+    at a time, and the formatted blocks are streamed to disk in chunks
+    of chunksize pairs instead of being accumulated in memory.
     """
     natoms = len(poscar["types"])
-    ntot = len(sposcar["types"])
 
-    shifts27 = list(
-        itertools.product(xrange(-1, 2), xrange(-1, 2), xrange(-1, 2)))
-    frange2 = frange * frange
+    shifts27 = np.array(
+        list(itertools.product(xrange(-1, 2), xrange(-1, 2), xrange(-1, 2))),
+        dtype=np.double)
+    lattvec = sposcar["lattvec"]
+    positions = sposcar["positions"]
 
+    car27 = _image_positions(sposcar)
+    selected = []
     nblocks = 0
-    f = StringIO.StringIO()
-    for ii, jj in itertools.product(xrange(natoms), xrange(ntot)):
-        if dmin[ii, jj] >= frange:
-            continue
-        jatom = jj % natoms
-        shiftsij = [shifts27[i] for i in shifts[ii, jj, :nequi[ii, jj]]]
-        for kk in xrange(ntot):
-            if dmin[ii, kk] >= frange:
-                continue
-            katom = kk % natoms
-            shiftsik = [shifts27[i] for i in shifts[ii, kk, :nequi[ii, kk]]]
-            d2min = np.inf
-            for shift2 in shiftsij:
-                carj = np.dot(sposcar["lattvec"],
-                              shift2 + sposcar["positions"][:, jj])
-                for shift3 in shiftsik:
-                    cark = np.dot(sposcar["lattvec"],
-                                  shift3 + sposcar["positions"][:, kk])
-                    d2 = ((carj - cark)**2).sum()
-                    if d2 < d2min:
-                        best2 = shift2
-                        best3 = shift3
-                        d2min = d2
-            if d2min >= frange2:
-                continue
-            nblocks += 1
-            Rj = np.dot(sposcar["lattvec"], best2 + sposcar["positions"][:, jj]
-                        - sposcar["positions"][:, jatom])
-            Rk = np.dot(sposcar["lattvec"], best3 + sposcar["positions"][:, kk]
-                        - sposcar["positions"][:, katom])
-            f.write("\n")
-            f.write("{:>5}\n".format(nblocks))
-            f.write("{0[0]:>15.10e} {0[1]:>15.10e} {0[2]:>15.10e}\n".format(
-                list(10. * Rj)))
-            f.write("{0[0]:>15.10e} {0[1]:>15.10e} {0[2]:>15.10e}\n".format(
-                list(10. * Rk)))
-            f.write(
-                "{:>6d} {:>6d} {:>6d}\n".format(ii + 1, jatom + 1, katom + 1))
-            for ll, mm, nn in itertools.product(
-                    xrange(3), xrange(3), xrange(3)):
-                f.write("{:>2d} {:>2d} {:>2d} {:>20.10e}\n".format(
-                    ll + 1, mm + 1, nn + 1, phifull[ll, mm, nn, ii, jj, kk]))
-    ffinal = open(filename, "w")
-    ffinal.write("{:>5}\n".format(nblocks))
-    ffinal.write(f.getvalue())
-    f.close()
-    ffinal.close()
+    for ii in xrange(natoms):
+        blocks = _select_ifc_blocks(
+            car27, dmin, nequi, shifts, frange, ii, chunksize)
+        nblocks += blocks[0].size
+        selected.append(blocks)
+
+    header = ("\n{:>5}\n"
+              "{:>15.10e} {:>15.10e} {:>15.10e}\n"
+              "{:>15.10e} {:>15.10e} {:>15.10e}\n"
+              "{:>6d} {:>6d} {:>6d}\n")
+    prefixes = [
+        "{:>2d} {:>2d} {:>2d} ".format(ll + 1, mm + 1, nn + 1)
+        for ll, mm, nn in itertools.product(xrange(3), xrange(3), xrange(3))]
+
+    iblock = 0
+    with open(filename, "w") as ffinal:
+        ffinal.write("{:>5}\n".format(nblocks))
+        for ii, (jjs, kks, best2s, best3s) in enumerate(selected):
+            for start in xrange(0, jjs.size, chunksize):
+                jj = jjs[start:start + chunksize]
+                kk = kks[start:start + chunksize]
+                jatom = jj % natoms
+                katom = kk % natoms
+                # image vectors as in the original loops, one np.dot each
+                dj = (shifts27[best2s[start:start + chunksize]]
+                      + positions[:, jj].T - positions[:, jatom].T)
+                dk = (shifts27[best3s[start:start + chunksize]]
+                      + positions[:, kk].T - positions[:, katom].T)
+                phi = phifull.take(ii, jj, kk).reshape((-1, 27))
+                lines = []
+                for vj, vk, ja, ka, vals in zip(dj, dk,
+                                                jatom.tolist(), katom.tolist(),
+                                                phi.tolist()):
+                    iblock += 1
+                    rj = (10. * np.dot(lattvec, vj)).tolist()
+                    rk = (10. * np.dot(lattvec, vk)).tolist()
+                    lines.append(header.format(iblock, *(rj + rk),
+                                               ii + 1, ja + 1, ka + 1))
+                    for prefix, val in zip(prefixes, vals):
+                        lines.append("{}{:>20.10e}\n".format(prefix, val))
+                ffinal.write("".join(lines))
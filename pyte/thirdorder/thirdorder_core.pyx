@@ -41,6 +41,8 @@ import scipy.linalg
 import scipy.sparse
 import scipy.sparse.linalg
 
+from pyte.thirdorder.thirdorder_common import SparseIFCs
+
 cimport cython
 cimport numpy as np
 np.import_array()
@@ -357,105 +359,99 @@ def reconstruct_ifcs(phipart,wedge,list4,poscar,sposcar):
     """
     Recover the full anharmonic IFC set from the irreducible set of
     force constants and the information contained in a wedge object.
+    Only the triplets equivalent to an irreducible one carry nonzero
+    constants, so the result is returned as a SparseIFCs object.
     """
-    cdef int ii,jj,ll,mm,nn,kk,ss,tt,ix,e0,e1,e2,e3
-    cdef int nlist,nlist4,natoms,ntot
-    cdef int ntotalindependent,tribasisindex,colindex,nrows,ncols
-    cdef int[:] naccumindependent
-    cdef int[:,:,:] vind1
-    cdef int[:,:,:] vind2
+    cdef int ii,jj,ss,tt,ix,ientry,tribasisindex,colindex
+    cdef int ll,mm,nn
+    cdef int nlist,natoms,ntot,nentries
+    cdef int ntotalindependent,nrows,ncols
+    cdef int[:] naccumindependent,vnequi,vnindependentbasis
+    cdef int[:,:] vtriplets
     cdef int[:,:,:] vequilist
     cdef double[:] aphilist
-    cdef double[:,:] vaa
+    cdef double[:,:] vaa,vvalues
     cdef double[:,:,:] vphipart
-    cdef double[:,:,:,:,:,:] vnruter
+    cdef double[:,:,:,:] vtrans
 
     nlist=wedge.nlist
     natoms=len(poscar["types"])
     ntot=len(sposcar["types"])
-    vnruter=np.zeros((3,3,3,natoms,ntot,ntot),dtype=np.double)
+    vnequi=wedge.nequi
+    vnindependentbasis=wedge.nindependentbasis
     naccumindependent=np.insert(np.cumsum(
         wedge.nindependentbasis[:nlist],dtype=np.intc),0,
         np.zeros(1,dtype=np.intc))
     ntotalindependent=naccumindependent[-1]
     vphipart=phipart
-    nlist4=len(list4)
-    for ii in xrange(nlist4):
-        e0,e1,e2,e3=list4[ii]
-        vnruter[e2,e3,:,e0,e1,:]=vphipart[:,ii,:]
+    # Position of each (i,j,ll,mm) 4-uple in the irreducible set.
+    index4={}
+    for ix in xrange(len(list4)):
+        index4[tuple(list4[ix])]=ix
     philist=[]
     for ii in xrange(nlist):
-        for jj in xrange(wedge.nindependentbasis[ii]):
+        for jj in xrange(vnindependentbasis[ii]):
             ll=wedge.independentbasis[jj,ii]//9
             mm=(wedge.independentbasis[jj,ii]%9)//3
             nn=wedge.independentbasis[jj,ii]%3
-            philist.append(vnruter[ll,mm,nn,
-                                  wedge.llist[0,ii],
-                                  wedge.llist[1,ii],
-                                  wedge.llist[2,ii]])
+            ix=index4.get((wedge.llist[0,ii],wedge.llist[1,ii],ll,mm),-1)
+            if ix<0:
+                philist.append(0.)
+            else:
+                philist.append(vphipart[nn,ix,wedge.llist[2,ii]])
     aphilist=np.array(philist,dtype=np.double)
-    vind1=-np.ones((natoms,ntot,ntot),dtype=np.intc)
-    vind2=-np.ones((natoms,ntot,ntot),dtype=np.intc)
+
+    # All triplets equivalent to an irreducible one, in (ii,jj) order.
     vequilist=wedge.allequilist
+    nentries=0
+    for ii in xrange(nlist):
+        nentries+=vnequi[ii]
+    triplets=np.empty((nentries,3),dtype=np.intc)
+    vtriplets=triplets
+    ientry=0
     for ii in xrange(nlist):
-        for jj in xrange(wedge.nequi[ii]):
-            vind1[vequilist[0,jj,ii],
-                  vequilist[1,jj,ii],
-                  vequilist[2,jj,ii]]=ii
-            vind2[vequilist[0,jj,ii],
-                  vequilist[1,jj,ii],
-                  vequilist[2,jj,ii]]=jj
+        for jj in xrange(vnequi[ii]):
+            for ll in xrange(3):
+                vtriplets[ientry,ll]=vequilist[ll,jj,ii]
+            ientry+=1
 
     vtrans=wedge.transformationarray
 
     nrows=ntotalindependent
     ncols=natoms*ntot*27
 
-    if nrows*ncols<=MAXDENSE:
+    if <double>nrows*ncols<=MAXDENSE:
         print("- Storing the coefficients in a dense matrix")
         aa=np.zeros((nrows,ncols),dtype=np.double)
         vaa=aa
-        colindex=0
-        for ii in xrange(natoms):
-            for jj in xrange(ntot):
-                tribasisindex=0
-                for ll in xrange(3):
-                    for mm in xrange(3):
-                        for nn in xrange(3):
-                            for kk in xrange(ntot):
-                                for ix in xrange(nlist):
-                                    if vind1[ii,jj,kk]==ix:
-                                        for ss in xrange(naccumindependent[ix],
-                                                         naccumindependent[ix+1]):
-                                            tt=ss-naccumindependent[ix]
-                                            vaa[ss,colindex]+=vtrans[tribasisindex,tt,
-                                                                     vind2[ii,jj,kk],ix]
-                            tribasisindex+=1
-                            colindex+=1
+        ientry=0
+        for ii in xrange(nlist):
+            for jj in xrange(vnequi[ii]):
+                colindex=(vtriplets[ientry,0]*ntot+vtriplets[ientry,1])*27
+                for tribasisindex in xrange(27):
+                    for ss in xrange(naccumindependent[ii],
+                                     naccumindependent[ii+1]):
+                        tt=ss-naccumindependent[ii]
+                        vaa[ss,colindex+tribasisindex]+=vtrans[tribasisindex,tt,
+                                                               jj,ii]
+                ientry+=1
     else:
         print("- Storing the coefficients in a sparse matrix")
         i=[]
         j=[]
         v=[]
-        colindex=0
-        for ii in xrange(natoms):
-            for jj in xrange(ntot):
-                tribasisindex=0
-                for ll in xrange(3):
-                    for mm in xrange(3):
-                        for nn in xrange(3):
-                            for kk in xrange(ntot):
-                                for ix in xrange(nlist):
-                                    if vind1[ii,jj,kk]==ix:
-                                        for ss in xrange(naccumindependent[ix],
-                                                         naccumindependent[ix+1]):
-                                            tt=ss-naccumindependent[ix]
-                                            i.append(ss)
-                                            j.append(colindex)
-                                            v.append(vtrans[tribasisindex,tt,
-                                                            vind2[ii,jj,kk],ix])
-                            tribasisindex+=1
-                            colindex+=1
+        ientry=0
+        for ii in xrange(nlist):
+            for jj in xrange(vnequi[ii]):
+                colindex=(vtriplets[ientry,0]*ntot+vtriplets[ientry,1])*27
+                for tribasisindex in xrange(27):
+                    for ss in xrange(naccumindependent[ii],
+                                     naccumindependent[ii+1]):
+                        tt=ss-naccumindependent[ii]
+                        i.append(ss)
+                        j.append(colindex+tribasisindex)
+                        v.append(vtrans[tribasisindex,tt,jj,ii])
+                ientry+=1
         print("- \t Density: {0:.2g}%".format(100.*len(i)/float(nrows*ncols)))
         aa=sp.sparse.coo_matrix((v,(i,j)),(nrows,ncols)).tocsr()
     D=sp.sparse.spdiags(aphilist,[0,],aphilist.size,aphilist.size,
@@ -467,22 +463,19 @@ def reconstruct_ifcs(phipart,wedge,list4,poscar,sposcar):
 
     aphilist+=compensation
 
-    # Build the final, full set of anharmonic IFCs.
-    vnruter[:,:,:,:,:,:]=0.
+    # Build the anharmonic IFCs of every stored triplet.
+    values=np.zeros((nentries,27),dtype=np.double)
+    vvalues=values
+    ientry=0
     for ii in xrange(nlist):
-        for jj in xrange(wedge.nequi[ii]):
-            for ll in xrange(3):
-                for mm in xrange(3):
-                    for nn in xrange(3):
-                        tribasisindex=(ll*3+mm)*3+nn
-                        for ix in xrange(wedge.nindependentbasis[ii]):
-                            vnruter[ll,mm,nn,vequilist[0,jj,ii],
-                                    vequilist[1,jj,ii],
-                                    vequilist[2,jj,ii]
-                                    ]+=wedge.transformationarray[
-                                        tribasisindex,ix,jj,ii]*aphilist[
-                                            naccumindependent[ii]+ix]
-    return vnruter
+        for jj in xrange(vnequi[ii]):
+            for tribasisindex in xrange(27):
+                for ix in xrange(vnindependentbasis[ii]):
+                    vvalues[ientry,tribasisindex]+=(
+                        vtrans[tribasisindex,ix,jj,ii]*
+                        aphilist[naccumindependent[ii]+ix])
+            ientry+=1
+    return SparseIFCs(triplets,values.reshape((nentries,3,3,3)),natoms,ntot)
 
 
 cdef class Wedge:
@@ -0,0 +1,270 @@
+import numpy as np
+import scipy as sp
+import scipy.sparse.linalg
+
+from pyte.util.calc import ForceRequest
+import pyte.thirdorder.thirdorder_core as thirdorder_core
+from pyte.thirdorder.thirdorder_ase import (
+    from_atoms,
+    to_atoms,
+    normalize_SPOSCAR,
+    build_unpermutation,
+)
+from pyte.thirdorder.thirdorder_common import (
+    SYMPREC,
+    gen_SPOSCAR,
+    calc_dists,
+    calc_frange,
+)
+
+
+def cell_translations(sposcar, natoms):
+    """
+    Permutations of sposcar atoms by each lattice translation, shaped
+    (ncells, ntot): atom x is moved to atom perms[s, x] by the s-th one.
+    """
+    na, nb, nc = sposcar["na"], sposcar["nb"], sposcar["nc"]
+    k, j, i, iat = np.indices((nc, nb, na, natoms)).reshape((4, -1))
+    perms = []
+    for dk, dj, di in np.indices((nc, nb, na)).reshape((3, -1)).T:
+        perms.append(
+            ((((k + dk) % nc * nb + (j + dj) % nb) * na + (i + di) % na)
+             * natoms + iat)
+        )
+    return np.array(perms)
+
+
+def _wedge_terms(wedge):
+    """
+    Atoms i, j, k of every triplet equivalent to each irreducible triplet
+    of wedge, with its coefficients shaped (nequi, alpha, beta gamma,
+    independent IFC) and its columns among the independent IFCs.
+    Returns the terms and the number of independent IFCs.
+    """
+    nlist = wedge.nlist
+    nind = wedge.nindependentbasis[:nlist]
+    naccum = np.concatenate([[0], np.cumsum(nind)])
+    terms = []
+    for ii in range(nlist):
+        nequi = wedge.nequi[ii]
+        if nind[ii] == 0:
+            continue
+        i, j, k = wedge.allequilist[:, :nequi, ii]
+        # trans[(alpha, beta, gamma), ix, equivalent] -> (eq, alpha, bg, ix)
+        coef = wedge.transformationarray[:, :nind[ii], :nequi, ii]
+        coef = coef.transpose((2, 0, 1)).reshape((nequi, 3, 9, nind[ii]))
+        terms.append((i, j, k, coef, slice(naccum[ii], naccum[ii + 1])))
+    return terms, int(naccum[-1])
+
+
+def _chunk_terms(terms, displacements, start, chunk_size):
+    """Terms with the products u_j u_k of samples start:start+chunk_size."""
+    disps = displacements[start:start + chunk_size]
+    for i, j, k, coef, cols in terms:
+        uu = (
+            disps[:, j, :, None] * disps[:, k, None, :]
+        ).reshape((len(disps), len(i), 9))
+        yield i, uu, coef, cols
+
+
+def design_operator(wedge, displacements, natoms, chunk_size=256):
+    """
+    Linear map from the independent anharmonic IFCs of wedge to the
+    quadratic forces -1/2 Phi u u on the first natoms atoms, for each
+    displacement field in displacements (nsamples, ntot, 3), as a
+    LinearOperator of shape (nsamples * natoms * 3, nparams). Products are
+    computed from the transformation array chunk_size samples at a time,
+    so the matrix is never stored. Also returns its rms entry.
+    """
+    terms, nparams = _wedge_terms(wedge)
+    nsamples = len(displacements)
+    chunks = range(0, nsamples, chunk_size)
+
+    def matvec(params):
+        params = np.ravel(params)
+        forces = np.zeros((nsamples, natoms, 3))
+        for start in chunks:
+            block = forces[start:start + chunk_size]
+            for i, uu, coef, cols in _chunk_terms(
+                terms, displacements, start, chunk_size
+            ):
+                coefp = coef @ params[cols]
+                contrib = -0.5 * np.einsum('seb,eab->sea', uu, coefp)
+                np.add.at(block, (slice(None), i), contrib)
+        return forces.reshape(-1)
+
+    def rmatvec(forces):
+        forces = np.reshape(forces, (nsamples, natoms, 3))
+        params = np.zeros(nparams)
+        for start in chunks:
+            block = forces[start:start + chunk_size]
+            for i, uu, coef, cols in _chunk_terms(
+                terms, displacements, start, chunk_size
+            ):
+                params[cols] -= 0.5 * np.einsum(
+                    'seb,sea,eabp->p', uu, block[:, i], coef, optimize=True
+                )
+        return params
+
+    # squared entries, summed column block by column block
+    sumsq = 0.
+    for start in chunks:
+        for i, uu, coef, cols in _chunk_terms(
+            terms, displacements, start, chunk_size
+        ):
+            block = np.zeros((len(uu), natoms, 3, coef.shape[-1]))
+            np.add.at(
+                block, (slice(None), i),
+                -0.5 * np.einsum('seb,eabp->seap', uu, coef),
+            )
+            sumsq += np.sum(block**2)
+    shape = (nsamples * natoms * 3, nparams)
+    rms = np.sqrt(sumsq / (shape[0] * shape[1])) if sumsq > 0 else 1.
+
+    operator = sp.sparse.linalg.LinearOperator(
+        shape, matvec=matvec, rmatvec=rmatvec, dtype=float
+    )
+    return operator, rms
+
+
+def sum_rule_matrix(wedge, natoms, ntot):
+    """
+    Sparse map from the independent IFCs to sum_k Phi_ijk for every
+    (i, j, alpha, beta, gamma), which vanishes by translational invariance.
+    """
+    nlist = wedge.nlist
+    nind = wedge.nindependentbasis[:nlist]
+    naccum = np.concatenate([[0], np.cumsum(nind)])
+    rows, cols, vals = [], [], []
+    for ii in range(nlist):
+        nequi = wedge.nequi[ii]
+        i, j, _ = wedge.allequilist[:, :nequi, ii]
+        coef = wedge.transformationarray[:, :nind[ii], :nequi, ii]
+        t, ix, eq = np.indices(coef.shape).reshape((3, -1))
+        rows.append((i[eq] * ntot + j[eq]) * 27 + t)
+        cols.append(naccum[ii] + ix)
+        vals.append(coef.reshape(-1))
+    return sp.sparse.coo_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(natoms * ntot * 27, naccum[-1]),
+    ).tocsr()
+
+
+def expand_ifcs(wedge, params):
+    """Triplets (n, 3) and their 3x3x3 IFCs from the independent IFCs."""
+    nlist = wedge.nlist
+    nind = wedge.nindependentbasis[:nlist]
+    naccum = np.concatenate([[0], np.cumsum(nind)])
+    triplets, values = [], []
+    for ii in range(nlist):
+        nequi = wedge.nequi[ii]
+        coef = wedge.transformationarray[:, :nind[ii], :nequi, ii]
+        triplets.append(wedge.allequilist[:, :nequi, ii].T)
+        values.append(np.einsum(
+            'tpe,p->et', coef, params[naccum[ii]:naccum[ii + 1]]
+        ).reshape((nequi, 3, 3, 3)))
+    return np.concatenate(triplets), np.concatenate(values)
+
+
+def _supercell_map(sposcar, supercell):
+    """Index in the phonopy supercell of each sposcar atom."""
+    diff = sposcar["positions"].T[:, None, :] - supercell.scaled_positions[None]
+    diff -= np.rint(diff)
+    dist = np.linalg.norm(diff @ supercell.cell, axis=2)
+    return np.argmin(dist, axis=1)
+
+
+def lsq_fc3_steps(
+    ph3, cut, relaxed_atoms, amplitude, num_snapshots=None, damp=1e-3,
+    seed=0,
+):
+    """
+    Fit fc3 of ph3 to forces of randomly displaced supercells.
+
+    Generator yielding one ForceRequest with num_snapshots pairs of
+    supercells displaced by +u and -u, u being Gaussian with standard
+    deviation amplitude (Angstrom). Half the sum of each pair cancels the
+    harmonic (and every odd) term, leaving -1/2 Phi u u. The independent
+    IFCs of thirdorder's Wedge within cut (as in thirdorder_steps) are
+    fitted to it, with every lattice translation of each pair as a sample
+    and the acoustic sum rule as extra equations, by damped lsqr; damp is
+    relative to the rms entry of the design matrix. By default
+    num_snapshots gives about four equations per independent IFC.
+    ph3.fc3 is set in compact form; returns the number of calculations.
+    """
+    na, nb, nc = np.diag(ph3.supercell_matrix)
+    if cut < 0:
+        nneigh = -int(cut)
+    elif cut > 0:
+        nneigh = None
+        frange = float(cut)
+    else:
+        raise ValueError('cut should not be zero')
+
+    poscar = from_atoms(relaxed_atoms)
+    natoms = len(poscar["types"])
+    symops = thirdorder_core.SymmetryOperations(
+        poscar["lattvec"], poscar["types"], poscar["positions"].T, SYMPREC)
+    sposcar = gen_SPOSCAR(poscar, na, nb, nc)
+    ntot = len(sposcar["types"])
+    dmin, nequi, shifts = calc_dists(sposcar)
+    if nneigh is not None:
+        frange = calc_frange(poscar, sposcar, nneigh, dmin)
+    wedge = thirdorder_core.Wedge(
+        poscar, sposcar, symops, dmin, nequi, shifts, frange
+    )
+    nparams = int(np.sum(wedge.nindependentbasis[:wedge.nlist]))
+
+    if num_snapshots is None:
+        num_snapshots = max(2, int(np.ceil(4 * nparams / (3 * ntot))))
+    rng = np.random.default_rng(seed)
+    disps = rng.normal(scale=amplitude, size=(num_snapshots, ntot, 3))
+
+    # supercells in normalized (VASP) order, sposcar order is [:, p]
+    p = build_unpermutation(sposcar)
+    order = np.argsort(p)
+    base = to_atoms(normalize_SPOSCAR(sposcar))
+    atoms_list = []
+    for disp in disps:
+        for sign in [1, -1]:
+            atoms = base.copy()
+            atoms.positions += sign * disp[order]
+            atoms_list.append(atoms)
+    forces = np.empty((len(atoms_list), ntot, 3))
+    yield ForceRequest(
+        atoms_list, 'fc3 calculate lsq', forces, range(len(atoms_list))
+    )
+    forces = forces[:, p, :]
+    quadratic = (forces[0::2] + forces[1::2]) / 2
+
+    # each translation of a snapshot is a sample for the first cell atoms
+    perms = cell_translations(sposcar, natoms)
+    samples = disps[:, perms].reshape((-1, ntot, 3))
+    targets = quadratic[:, perms[:, :natoms]].reshape(-1)
+
+    amat, scale = design_operator(wedge, samples, natoms)
+    sum_rule = scale * sum_rule_matrix(wedge, natoms, ntot)
+    nrows = amat.shape[0]
+    system = sp.sparse.linalg.LinearOperator(
+        (nrows + sum_rule.shape[0], amat.shape[1]),
+        matvec=lambda x: np.concatenate(
+            [amat.matvec(x), sum_rule @ np.ravel(x)]
+        ),
+        rmatvec=lambda y: (
+            amat.rmatvec(y[:nrows]) + sum_rule.T @ np.ravel(y[nrows:])
+        ),
+        dtype=float,
+    )
+    rhs = np.concatenate([targets, np.zeros(sum_rule.shape[0])])
+    params = sp.sparse.linalg.lsqr(system, rhs, damp=damp * scale)[0]
+
+    triplets, values = expand_ifcs(wedge, params)
+    smap = _supercell_map(sposcar, ph3.supercell)
+    s2p = {s: i for i, s in enumerate(ph3.primitive.p2s_map)}
+    fc3 = np.zeros((len(s2p), ntot, ntot, 3, 3, 3))
+    i, j, k = triplets.T
+    # repeated triplets add up, as in thirdorder's SparseIFCs
+    np.add.at(fc3, ([s2p[s] for s in smap[i]], smap[j], smap[k]), values)
+    ph3.fc3 = fc3
+
+    return len(atoms_list)
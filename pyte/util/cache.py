@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from ase.calculators.singlepoint import SinglePointCalculator
+
+RESULT_KEYS = ['energy', 'forces', 'stress']
+
+
+def calc_identity(config):
+    """
+    Identity string of the calculator in config. A model given as a file
+    is identified by its path, size and modification time.
+    """
+    calc_config = config['calculator']
+    identity = {
+        'calc_type': calc_config['calc_type'].lower(),
+        'path': calc_config['path'],
+        'calc_args': calc_config.get('calc_args', {}),
+    }
+    if os.path.isfile(path := calc_config['path']):
+        stat = os.stat(path)
+        identity['path'] = os.path.abspath(path)
+        identity['file'] = [stat.st_size, stat.st_mtime_ns]
+    return json.dumps(identity, sort_keys=True, default=str)
+
+
+class ForceCache:
+    """
+    Content-addressed on-disk cache of energies, forces and stresses.
+
+    Entries are keyed by a hash of cell, species, positions, pbc and the
+    calculator identity, and stored as one .npz file each. Once the cache
+    exceeds max_size bytes, least recently used entries are evicted.
+    """
+    def __init__(self, directory, identity, max_size=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.identity = identity
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith('.npz'):
+                stat = os.stat(path := os.path.join(directory, name))
+                entries.append((stat.st_mtime, path, stat.st_size))
+        self._entries = OrderedDict(
+            (path, size) for _, path, size in sorted(entries)
+        )
+        self.size = sum(self._entries.values())
+
+    def _path(self, atoms):
+        digest = hashlib.sha256(self.identity.encode())
+        for array in [
+            atoms.get_cell().array,
+            atoms.get_atomic_numbers().astype(np.int64),
+            atoms.get_positions(),
+            atoms.get_pbc(),
+        ]:
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return os.path.join(self.directory, f'{digest.hexdigest()}.npz')
+
+    def get(self, atoms):
+        path = self._path(atoms)
+        try:
+            with np.load(path) as data:
+                result = {key: data[key] for key in RESULT_KEYS}
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+
+        os.utime(path)
+        if path in self._entries:
+            self._entries.move_to_end(path)
+        self.hits += 1
+        result['energy'] = float(result['energy'])
+        return result
+
+    def put(self, atoms, result):
+        path = self._path(atoms)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **{key: result[key] for key in RESULT_KEYS})
+        os.replace(tmp_path, path)
+
+        self.size += os.path.getsize(path) - self._entries.pop(path, 0)
+        self._entries[path] = os.path.getsize(path)
+        self._evict()
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        while self.size > self.max_size and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def calculate(self, atoms_list, calculate_func, forces_out=None, rows=None):
+        """
+        Return calculated atoms for atoms_list, calling calculate_func
+        only on the structures that are not cached yet. If forces_out is
+        given, forces of the i-th structure are written to
+        forces_out[rows[i]] instead and forces_out is returned; calculated
+        atoms are then only created for the structures not cached.
+        """
+        result = [None] * len(atoms_list)
+        todo = []
+        for i, atoms in enumerate(atoms_list):
+            if (cached := self.get(atoms)) is None:
+                todo.append(i)
+            elif forces_out is not None:
+                forces_out[rows[i]] = cached['forces']
+            else:
+                result[i] = SinglePointCalculator(atoms, **cached).get_atoms()
+
+        if todo:
+            calculated = calculate_func([atoms_list[i] for i in todo])
+            for i, atoms in zip(todo, calculated):
+                self.put(atoms_list[i], atoms.calc.results)
+                if forces_out is not None:
+                    forces_out[rows[i]] = atoms.get_forces()
+                else:
+                    result[i] = atoms
+        if forces_out is not None:
+            return forces_out
+        return result
+
+
+def cache_from_config(config):
+    calc_config = config['calculator']
+    if not (cache_path := calc_config['cache_path']):
+        return None
+
+    max_size = calc_config['cache_size']
+    if max_size is not None:
+        max_size = int(max_size * 1024**2)  # MB to bytes
+    return ForceCache(cache_path, calc_identity(config), max_size)
@@ -1,17 +1,23 @@
+import multiprocessing as mp
+import time
+from collections import namedtuple
+
 import numpy as np
 from tqdm import tqdm
 
 from ase.calculators.singlepoint import SinglePointCalculator
 
+from pyte.util.parallel import CalculatorClient
+
 try:
     import torch
-    from torch_geometric.loader import DataLoader
+    from torch_geometric.data import Batch
+    from torch.utils.data import DataLoader
     from sevenn.util import to_atom_graph_list
     import sevenn._keys as KEY
-    from sevenn.train.atoms_dataset import SevenNetAtomsDataset
-    from sevenn.train.modal_dataset import SevenNetMultiModalDataset
+    from sevenn.atom_graph_data import AtomGraphData
     import sevenn.train.dataload as dataload
-    from sevenn.train.dataload import _set_atoms_y
+    from pyte.util.neighbor import NeighborListCache
     from sevenn.calculator import SevenNetCalculator
 except:
     # Dummy class to avoid error
@@ -19,7 +25,80 @@ except:
         pass
 
 
+def _build_graph(atoms, cutoff, modal=None, neighbors=None):
+    if neighbors is not None:
+        graph = neighbors.build(atoms)
+    else:
+        graph = dataload.unlabeled_atoms_to_graph(atoms, cutoff)
+    graph = AtomGraphData.from_numpy_dict(graph)
+    if modal is not None:
+        graph[KEY.DATA_MODALITY] = modal
+    return graph
+
+
+class GraphBatchDataset:
+    """
+    Map-style dataset whose item for a list of atoms, given as the index,
+    is their collated graph batch. With BatchSampler as sampler, one
+    DataLoader with persistent workers builds the batches of every
+    call ahead of the model. neighbors, a NeighborListCache, is copied to
+    each worker once and kept there.
+    """
+    def __init__(self, cutoff, modal=None, neighbors=None):
+        self.cutoff = cutoff
+        self.modal = modal
+        self.neighbors = neighbors
+
+    def __getitem__(self, atoms_list):
+        return Batch.from_data_list([
+            _build_graph(atoms, self.cutoff, self.modal, self.neighbors)
+            for atoms in atoms_list
+        ])
+
+
+class BatchSampler:
+    """Sampler yielding the atoms of each batch of the current call."""
+    def __init__(self):
+        self.batches = []
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+def _no_collate(batch):
+    # items are already collated batches
+    return batch
+
+
+def _estimate_edges(atoms, cutoff):
+    """Number of edges of atoms if they were spread evenly over the cell."""
+    volume = abs(atoms.cell.volume)
+    if volume == 0.:
+        return len(atoms) * (len(atoms) - 1)
+    return len(atoms)**2 * 4 / 3 * np.pi * cutoff**3 / volume
+
+
 class SevenNetBatchCalculator(SevenNetCalculator):
+    """
+    SevenNet calculator evaluating many structures per model call.
+
+    Structures are sorted by graph size and packed greedily into batches
+    holding at most avg_atom_num atoms, max_edges edges and batch_size
+    structures (whichever are given). Edges are estimated from the atom
+    density, corrected by the ratio of actual to estimated edges seen so
+    far. Graphs of the next batches are built by graph_workers persistent
+    DataLoader processes while the model runs (in this process if
+    graph_workers is 0). A batch with more than max_edges edges, or one
+    that runs out of memory, is split in half and retried; out-of-memory
+    also halves the budgets of later calls.
+    With nl_skin, neighbor lists of displaced copies of one supercell are
+    derived from a cached reference (see NeighborListCache); each graph
+    worker keeps its own cache for the lifetime of the calculator.
+    Packing statistics accumulate in pack_stats.
+    """
     # TODO: implement this in original sevennet
     # To avoid dependency issues with pyte
     def __init__(
@@ -35,6 +114,10 @@ class SevenNetBatchCalculator(SevenNetCalculator):
         sevennet_config=None,
         batch_size=None,
         avg_atom_num=None,
+        max_edges=None,
+        graph_workers=0,
+        prefetch_factor=2,
+        nl_skin=None,
         **kwargs
     ):
         super().__init__(
@@ -49,58 +132,207 @@ class SevenNetBatchCalculator(SevenNetCalculator):
             sevennet_config=sevennet_config,
             **kwargs
         )
-        if batch_size is None and avg_atom_num is None:
-            raise ValueError('one of batch size or avg_atom_num should be given')
+        if batch_size is None and avg_atom_num is None and max_edges is None:
+            raise ValueError(
+                'one of batch size, avg_atom_num or max_edges should be given'
+            )
 
         self.batch_size = batch_size
         self.avg_atom_num = avg_atom_num
+        self.max_edges = max_edges
+        self.graph_workers = graph_workers
+        self.neighbors = None
+        if nl_skin:
+            self.neighbors = NeighborListCache(self.cutoff, nl_skin)
+        self.prefetch_factor = prefetch_factor
+        self.dataset = GraphBatchDataset(self.cutoff, self.modal, self.neighbors)
+        self.sampler = BatchSampler()
+        self.loader = None
+        self.budget_scale = 1.
+        self.pack_stats = {
+            'num_batches': 0,
+            'num_structures': 0,
+            'num_oom': 0,
+            'utilization': 0.,
+            'num_edges': 0,
+            'estimated_edges': 0.,
+        }
 
 
-    def batch_calculate(self, atoms_list, desc=None):
-        self.model.set_is_batch_data(True)
-        dataset = SevenNetAtomsDataset(self.cutoff, [])
-        def _unlabeled_graph_build(self, atoms):
-            #return dataload.atoms_to_graph(
-            return dataload.unlabeled_atoms_to_graph(
-            atoms,
-            self.cutoff,
-            # transfer_info=False,
-            # y_from_calc=False,
-            # allow_unlabeled=True,
-        )
-        SevenNetAtomsDataset._graph_build = _unlabeled_graph_build  # TODO: avoid monkey patching
-        # atoms_list = _set_atoms_y(atoms_list)
-        dataset._atoms_list = atoms_list
+    def _budget(self, limit):
+        if limit is None:
+            return None
+        return max(1, int(limit * self.budget_scale))
 
-        if self.modal is not None:
-            dataset = SevenNetMultiModalDataset({self.modal: dataset})
 
-        if self.batch_size is None:
-            total_atom_num = sum([len(atoms) for atoms in atoms_list])
-            batch_size = int(self.avg_atom_num * len(atoms_list) / total_atom_num)
-        else:
-            batch_size = self.batch_size
+    @property
+    def edge_ratio(self):
+        """Actual over estimated edges of the graphs evaluated so far."""
+        if self.pack_stats['estimated_edges'] == 0:
+            return 1.
+        return self.pack_stats['num_edges'] / self.pack_stats['estimated_edges']
+
 
-        batch_size = max(1, batch_size)
-        loader = DataLoader(dataset, batch_size, shuffle=False)
+    def _pack(self, sizes):
+        """
+        Split structures, given as (num_atoms, num_edges) in size order,
+        into consecutive batches filling the budgets. Returns lists of
+        positions and the fill ratio of each batch.
+        """
+        budgets = [
+            self._budget(limit)
+            for limit in [self.batch_size, self.avg_atom_num, self.max_edges]
+        ]
+        batches, fills = [], []
+        batch, used = [], [0, 0, 0]
+        for i, (num_atoms, num_edges) in enumerate(sizes):
+            need = [1, num_atoms, num_edges]
+            if batch and any(
+                limit is not None and u + n > limit
+                for limit, u, n in zip(budgets, used, need)
+            ):
+                batches.append(batch)
+                fills.append(self._fill(budgets, used))
+                batch, used = [], [0, 0, 0]
+            batch.append(i)
+            used = [u + n for u, n in zip(used, need)]
+        if batch:
+            batches.append(batch)
+            fills.append(self._fill(budgets, used))
+        return batches, fills
+
+
+    @staticmethod
+    def _fill(budgets, used):
+        return max(
+            u / limit for limit, u in zip(budgets, used) if limit is not None
+        )
+
+
+    def _evaluate(self, batch):
+        batch = batch.to(self.device, non_blocking=True)
+        output_list = self.model(batch)
         result_dict_list = []
+        for output in to_atom_graph_list(output_list):
+            energy = output[KEY.PRED_TOTAL_ENERGY].detach().cpu().item()
+            num_atoms = output['num_atoms'].item()
+            forces = output[KEY.PRED_FORCE].detach().cpu().numpy()[:num_atoms, :]
+            stress = np.array(
+                (-output[KEY.PRED_STRESS][0])
+                .detach()
+                .cpu()
+                .numpy()[[0, 1, 2, 4, 5, 3]]
+            )
+            result_dict = {'energy': energy, 'forces': forces, 'stress': stress}
+            result_dict_list.append(result_dict)
+        return result_dict_list
 
-        for batch in tqdm(loader, desc=desc, leave=False):
-            batch = batch.to(self.device)
-            output_list = self.model(batch)
-            for output in to_atom_graph_list(output_list):    
-                energy = output[KEY.PRED_TOTAL_ENERGY].detach().cpu().item()
-                num_atoms = output['num_atoms'].item()
-                forces = output[KEY.PRED_FORCE].detach().cpu().numpy()[:num_atoms, :]
-                stress = np.array(
-                    (-output[KEY.PRED_STRESS][0])
-                    .detach()
-                    .cpu()
-                    .numpy()[[0, 1, 2, 4, 5, 3]]
-                )
-                result_dict = {'energy': energy, 'forces': forces, 'stress': stress}
-                result_dict_list.append(result_dict)
 
+    def _split(self, batch):
+        graphs = batch.to_data_list()
+        half = len(graphs) // 2
+        return (
+            self._evaluate_with_backoff(Batch.from_data_list(graphs[:half]))
+            + self._evaluate_with_backoff(Batch.from_data_list(graphs[half:]))
+        )
+
+
+    def _evaluate_with_backoff(self, batch):
+        max_edges = self._budget(self.max_edges)
+        if (
+            max_edges is not None and batch.num_graphs > 1
+            and batch[KEY.EDGE_IDX].shape[1] > max_edges
+        ):
+            return self._split(batch)
+
+        try:
+            return self._evaluate(batch)
+        except (RuntimeError, MemoryError) as e:
+            oom = isinstance(e, MemoryError) or 'out of memory' in str(e)
+            if not oom or batch.num_graphs == 1:
+                raise
+        # outside except, so the failed batch can be freed
+        self.pack_stats['num_oom'] += 1
+        self.budget_scale /= 2
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return self._split(batch.cpu())
+
+
+    def _graph_batches(self, atoms_batches):
+        """
+        Iterate over the collated graph batches of atoms_batches. With
+        graph_workers, one DataLoader is created on first use and its
+        workers are kept for later calls.
+        """
+        if self.graph_workers == 0:
+            return (self.dataset[atoms_batch] for atoms_batch in atoms_batches)
+        if self.loader is None:
+            self.loader = DataLoader(
+                self.dataset,
+                batch_size=None,
+                sampler=self.sampler,
+                collate_fn=_no_collate,
+                num_workers=self.graph_workers,
+                prefetch_factor=self.prefetch_factor,
+                persistent_workers=True,
+                pin_memory=torch.device(self.device).type == 'cuda',
+            )
+        self.sampler.batches = atoms_batches
+        return iter(self.loader)
+
+
+    def batch_calculate(
+        self, atoms_list, desc=None, cache=None, forces_out=None, rows=None
+    ):
+        """
+        Calculate atoms_list and return it as single point atoms. If
+        forces_out is given, forces of the i-th structure are written to
+        forces_out[rows[i]] instead and forces_out is returned.
+        """
+        if cache is not None:
+            return cache.calculate(
+                atoms_list,
+                lambda todo: self.batch_calculate(todo, desc=desc),
+                forces_out=forces_out,
+                rows=rows,
+            )
+
+        self.model.set_is_batch_data(True)
+        estimated = [_estimate_edges(atoms, self.cutoff) for atoms in atoms_list]
+        sizes = [
+            (len(atoms), edges * self.edge_ratio)
+            for atoms, edges in zip(atoms_list, estimated)
+        ]
+        order = sorted(range(len(atoms_list)), key=lambda i: sizes[i][::-1])
+        batches, fills = self._pack([sizes[i] for i in order])
+        batches = [[order[i] for i in batch] for batch in batches]
+
+        result_dict_list = [None] * len(atoms_list)
+        for indices, fill, batch in zip(
+            batches,
+            fills,
+            tqdm(
+                self._graph_batches(
+                    [[atoms_list[i] for i in indices] for indices in batches]
+                ),
+                total=len(batches), desc=desc, leave=False,
+            ),
+        ):
+            self.pack_stats['num_edges'] += batch[KEY.EDGE_IDX].shape[1]
+            self.pack_stats['estimated_edges'] += sum(estimated[i] for i in indices)
+            result_dicts = self._evaluate_with_backoff(batch)
+            for i, result_dict in zip(indices, result_dicts):
+                if forces_out is not None:
+                    forces_out[rows[i]] = result_dict['forces']
+                else:
+                    result_dict_list[i] = result_dict
+            self.pack_stats['num_batches'] += 1
+            self.pack_stats['num_structures'] += len(indices)
+            self.pack_stats['utilization'] += fill
+
+        if forces_out is not None:
+            return forces_out
         result = []
         for atoms, result_dict in zip(atoms_list, result_dict_list):
             single_calc = SinglePointCalculator(atoms, **result_dict)
@@ -109,6 +341,18 @@ class SevenNetBatchCalculator(SevenNetCalculator):
         return result
 
 
+    def pack_summary(self):
+        stats = self.pack_stats
+        num_batches = max(1, stats['num_batches'])
+        return (
+            f'{stats["num_batches"]} batches, '
+            + f'{stats["num_structures"] / num_batches:.1f} structures/batch, '
+            + f'{100 * stats["utilization"] / num_batches:.1f}% of budget used, '
+            + f'{stats["num_oom"]} out-of-memory retries, '
+            + f'{self.edge_ratio:.2f} actual/estimated edges'
+        )
+
+
 def calc_from_py(script):
     import importlib.util
     from pathlib import Path
@@ -122,21 +366,78 @@ def calc_from_py(script):
     return calc
 
 
+# calculator of a ParallelCalculator worker process
+_worker_calc = None
+
+
+def _init_worker_calc(config):
+    global _worker_calc
+    _worker_calc = calc_from_config(config)
+
+
+def _worker_calculate(atoms):
+    return single_point_calculate(atoms, _worker_calc)
+
+
+class ParallelCalculator:
+    """
+    Evaluate structures with one calculator per worker process, for
+    calculators without batch evaluation. Each worker builds its own
+    calculator with calc_from_config, so any calc_type that works
+    serially works here. Results keep the order of the input.
+    """
+    def __init__(self, config, num_workers):
+        config = dict(config)
+        config['calculator'] = dict(config['calculator'], num_workers=0)
+        self.num_workers = num_workers
+        ctx = mp.get_context('spawn')
+        self.pool = ctx.Pool(
+            num_workers, initializer=_init_worker_calc, initargs=(config,)
+        )
+
+    def batch_calculate(self, atoms_list, desc=None, cache=None):
+        if cache is not None:
+            return cache.calculate(
+                atoms_list, lambda todo: self.batch_calculate(todo, desc=desc)
+            )
+
+        chunksize = max(1, len(atoms_list) // (4 * self.num_workers))
+        return list(tqdm(
+            self.pool.imap(_worker_calculate, atoms_list, chunksize),
+            total=len(atoms_list),
+            desc=desc,
+            leave=False,
+        ))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
 def calc_from_config(config):
     calc_config = config['calculator']
     calc_type = calc_config['calc_type'].lower()
     calc_args = calc_config.get('calc_args', {})
 
+    if (num_workers := calc_config.get('num_workers', 0)) > 0:
+        return ParallelCalculator(config, num_workers)
+
     if calc_type == 'sevennet':
         return SevenNetCalculator(model=calc_config['path'], **calc_args)
 
     elif calc_type == 'sevennet-batch':
         batch_size = calc_config.get('batch_size', None)
         avg_atom_num = calc_config.get('avg_atom_num', None)
+        max_edges = calc_config.get('max_edges', None)
+        graph_workers = calc_config.get('graph_workers', 0)
+        nl_skin = calc_config.get('nl_skin', None)
         return SevenNetBatchCalculator(
             model=calc_config['path'],
             batch_size=batch_size,
             avg_atom_num=avg_atom_num,
+            max_edges=max_edges,
+            graph_workers=graph_workers,
+            nl_skin=nl_skin,
             **calc_args,
         )
     elif calc_type == 'custom':
@@ -160,9 +461,369 @@ def single_point_calculate(atoms, calc):
     return new_atoms
 
 
-def single_point_calculate_list(atoms_list, calc, desc=None):
+def single_point_calculate_list(atoms_list, calc, desc=None, cache=None):
+    if cache is not None:
+        return cache.calculate(
+            atoms_list,
+            lambda todo: single_point_calculate_list(todo, calc, desc=desc),
+        )
+
     calculated = []
     for atoms in tqdm(atoms_list, desc=desc, leave=False):
         calculated.append(single_point_calculate(atoms, calc))
 
     return calculated
+
+
+def profile_calculator(calc):
+    """
+    Wrap calc.calculate so that the time spent in it and the number of
+    calls accumulate in calc.profile.
+    """
+    calc.profile = {'model_time': 0., 'num_calls': 0}
+    calculate = calc.calculate
+
+    def timed_calculate(*args, **kwargs):
+        init_time = time.time()
+        try:
+            return calculate(*args, **kwargs)
+        finally:
+            calc.profile['model_time'] += time.time() - init_time
+            calc.profile['num_calls'] += 1
+
+    calc.calculate = timed_calculate
+    return calc
+
+
+def split_by_atoms(elapsed, atoms_lists):
+    """
+    Share elapsed time of one merged evaluation among atoms_lists in
+    proportion to their total number of atoms.
+    """
+    sizes = [sum(len(atoms) for atoms in atoms_list) for atoms_list in atoms_lists]
+    total = sum(sizes)
+    if total == 0:
+        return [0. for _ in sizes]
+    return [elapsed * size / total for size in sizes]
+
+
+def calculate_atoms_list(atoms_list, calc, desc=None, cache=None):
+    if hasattr(calc, 'batch_calculate'):
+        return calc.batch_calculate(atoms_list, desc=desc, cache=cache)
+    return single_point_calculate_list(atoms_list, calc, desc=desc, cache=cache)
+
+
+def fill_forces(out, rows, atoms_list):
+    for row, atoms in zip(rows, atoms_list):
+        out[row] = atoms.get_forces()
+    return out
+
+
+class ForceRouter:
+    """
+    Force output spanning the out arrays of several ForceRequests: item i
+    is out[row] of the i-th (out, row) of targets.
+    """
+    def __init__(self, targets):
+        self.targets = targets
+
+    def __setitem__(self, i, forces):
+        out, row = self.targets[i]
+        out[row] = forces
+
+
+def calculate_forces(atoms_list, calc, out, rows, desc=None, cache=None):
+    """
+    Write forces of the i-th structure of atoms_list to out[rows[i]] and
+    return out. The sevennet batch calculator and the calculator server
+    client write them directly, without creating calculated Atoms.
+    """
+    if isinstance(calc, (SevenNetBatchCalculator, CalculatorClient)):
+        return calc.batch_calculate(
+            atoms_list, desc=desc, cache=cache, forces_out=out, rows=rows
+        )
+    return fill_forces(
+        out, rows, calculate_atoms_list(atoms_list, calc, desc, cache)
+    )
+
+
+def calculate_hessian(calc, atoms, block_size=64):
+    """
+    Hessian of the energy of atoms in eV/Angstrom^2, shaped as phonopy
+    force constants (natoms, natoms, 3, 3), by automatic differentiation
+    of a SevenNet model. Rows are computed as Hessian-vector products of
+    the force output, block_size rows per backward pass.
+    """
+    if not isinstance(calc, SevenNetCalculator) or not hasattr(calc, 'model'):
+        raise ValueError('hessian needs a sevennet calculator')
+    natoms = len(atoms)
+    model = calc.model
+    batch = Batch.from_data_list([_build_graph(atoms, calc.cutoff, calc.modal)])
+    batch = batch.to(calc.device)
+    pos = batch[KEY.POS].requires_grad_(True)
+
+    training = model.training
+    is_batch_data = getattr(model, 'is_batch_data', False)
+    # force output is differentiable only in training mode
+    model.train()
+    model.set_is_batch_data(True)
+    try:
+        forces = model(batch)[KEY.PRED_FORCE]
+        hessian = np.zeros((3 * natoms, 3 * natoms))
+        for start in range(0, 3 * natoms, block_size):
+            rows = range(start, min(start + block_size, 3 * natoms))
+            vectors = torch.zeros(
+                (len(rows), 3 * natoms), dtype=forces.dtype, device=forces.device
+            )
+            vectors[torch.arange(len(rows)), list(rows)] = 1.
+            vectors = vectors.reshape((len(rows), natoms, 3))
+            try:
+                hvp, = torch.autograd.grad(
+                    forces, pos, vectors, retain_graph=True,
+                    is_grads_batched=True,
+                )
+            except RuntimeError:
+                # some scatter ops cannot be batched, one row at a time
+                hvp = torch.stack([
+                    torch.autograd.grad(forces, pos, v, retain_graph=True)[0]
+                    for v in vectors
+                ])
+            hvp = hvp.reshape((len(rows), -1)).detach().cpu().numpy()
+            hessian[start:rows.stop] = -hvp
+    finally:
+        model.train(training)
+        model.set_is_batch_data(is_batch_data)
+
+    hessian = (hessian + hessian.T) / 2
+    return hessian.reshape((natoms, 3, natoms, 3)).transpose((0, 2, 1, 3)).copy()
+
+
+# Yielded by force-constant generators when they need the Hessian of
+# atoms, a pristine supercell, instead of forces of displaced ones.
+HessianRequest = namedtuple('HessianRequest', ['atoms', 'desc', 'block_size'])
+
+
+# Yielded by force-constant generators when they need calculated atoms.
+# If out is given, forces are written to out[rows] and out is sent back.
+ForceRequest = namedtuple(
+    'ForceRequest', ['atoms_list', 'desc', 'out', 'rows'],
+    defaults=[None, None],
+)
+
+
+def run_requests(steps, calc):
+    """
+    Drive a generator yielding ForceRequests with a single calculator and
+    return its value. Calculator errors are raised inside the generator.
+    """
+    try:
+        request = next(steps)
+        while True:
+            try:
+                if isinstance(request, HessianRequest):
+                    result = calculate_hessian(
+                        calc, request.atoms, request.block_size
+                    )
+                elif request.out is not None:
+                    result = calculate_forces(
+                        request.atoms_list, calc, request.out, request.rows,
+                        desc=request.desc,
+                    )
+                else:
+                    result = calculate_atoms_list(
+                        request.atoms_list, calc, desc=request.desc
+                    )
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+class DisplacementScheduler:
+    """
+    Evaluate displaced supercells of many structures together.
+
+    Generators yielding ForceRequests are advanced in lockstep, up to
+    max_active at a time. In each round the pending requests are merged
+    into one global queue, sorted by atom count so that similar sizes
+    share batches, evaluated with one calculator call and routed back.
+
+    Per-key profiles are kept in stats: wall time from the first to the
+    last step of the generator, its share of calculator time and number
+    of evaluated supercells.
+    """
+    def __init__(self, calc, max_active=1, cache=None):
+        self.calc = calc
+        self.max_active = max_active
+        self.cache = cache
+        self.num_calculated = 0
+        self.calc_time = 0.
+        self.stats = {}
+
+    def key_stats(self, key):
+        return self.stats.setdefault(
+            key, {'wall_time': 0., 'model_time': 0., 'num_calls': 0}
+        )
+
+    @property
+    def throughput(self):
+        """Evaluated supercells per second of calculator time."""
+        if self.calc_time == 0.:
+            return 0.
+        return self.num_calculated / self.calc_time
+
+    def calculate(
+        self, atoms_lists, desc='force calculation', keys=None, outs=None
+    ):
+        """
+        Evaluate atoms_lists with one calculator call and return the
+        calculated atoms of each. outs may give, for each atoms_list, the
+        (out, rows) of its ForceRequest, or None: forces are then written
+        to out[rows[i]] and out is returned instead. If every atoms_list
+        has one, no calculated Atoms are created.
+        """
+        outs = [None] * len(atoms_lists) if outs is None else outs
+        flat = [atoms for atoms_list in atoms_lists for atoms in atoms_list]
+        if not flat:
+            return [[] if out is None else out[0] for out in outs]
+        order = sorted(range(len(flat)), key=lambda i: len(flat[i]))
+
+        init_time = time.time()
+        if all(out is not None for out in outs):
+            targets = [(out, row) for out, rows in outs for row in rows]
+            calculate_forces(
+                [flat[i] for i in order],
+                self.calc,
+                ForceRouter([targets[i] for i in order]),
+                range(len(flat)),
+                desc,
+                self.cache,
+            )
+        else:
+            result = calculate_atoms_list(
+                [flat[i] for i in order], self.calc, desc, self.cache
+            )
+        elapsed = time.time() - init_time
+        self.calc_time += elapsed
+        self.num_calculated += len(flat)
+        if keys is not None:
+            shares = split_by_atoms(elapsed, atoms_lists)
+            for key, atoms_list, share in zip(keys, atoms_lists, shares):
+                stats = self.key_stats(key)
+                stats['model_time'] += share
+                stats['num_calls'] += len(atoms_list)
+
+        if all(out is not None for out in outs):
+            return [out for out, _ in outs]
+        unsorted = [None] * len(flat)
+        for i, atoms in zip(order, result):
+            unsorted[i] = atoms
+        results, start = [], 0
+        for atoms_list, out in zip(atoms_lists, outs):
+            calculated = unsorted[start:start + len(atoms_list)]
+            start += len(atoms_list)
+            if out is not None:
+                calculated = fill_forces(*out, calculated)
+            results.append(calculated)
+        return results
+
+    def calculate_each(
+        self, atoms_lists, desc='force calculation', keys=None, outs=None
+    ):
+        """
+        As calculate, but an error is returned in place of the results
+        instead of being raised. If the merged evaluation fails, each
+        atoms_list is evaluated on its own, so that only the ones that
+        fail get their error.
+        """
+        try:
+            return self.calculate(atoms_lists, desc, keys, outs)
+        except Exception as e:
+            if len(atoms_lists) == 1:
+                return [e]
+        results = []
+        for i, atoms_list in enumerate(atoms_lists):
+            key = None if keys is None else keys[i:i + 1]
+            out = None if outs is None else outs[i:i + 1]
+            try:
+                results.append(self.calculate([atoms_list], desc, key, out)[0])
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def hessian(self, request, key=None):
+        """Hessian of a HessianRequest, or the exception raised."""
+        init_time = time.time()
+        try:
+            return calculate_hessian(self.calc, request.atoms, request.block_size)
+        except Exception as e:
+            return e
+        finally:
+            elapsed = time.time() - init_time
+            self.calc_time += elapsed
+            self.num_calculated += 1
+            if key is not None:
+                stats = self.key_stats(key)
+                stats['model_time'] += elapsed
+                stats['num_calls'] += 1
+
+    def _advance(self, pending, key, steps, value):
+        started = self.started.setdefault(key, time.time())
+        try:
+            if value is None:
+                request = next(steps)
+            elif isinstance(value, Exception):
+                request = steps.throw(value)
+            else:
+                request = steps.send(value)
+        except StopIteration as stop:
+            del self.started[key]
+            self.key_stats(key)['wall_time'] += time.time() - started
+            yield key, stop.value
+        else:
+            pending[key] = (steps, request)
+
+    def run(self, keyed_steps):
+        """
+        Run generators given as (key, generator) pairs and yield
+        (key, returned value) as each one finishes.
+        """
+        keyed_steps = iter(keyed_steps)
+        pending = {}
+        self.started = {}
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < self.max_active:
+                try:
+                    key, steps = next(keyed_steps)
+                except StopIteration:
+                    exhausted = True
+                    break
+                yield from self._advance(pending, key, steps, None)
+            if not pending:
+                continue
+
+            results = {}
+            keys = []
+            for key, (_, request) in pending.items():
+                if isinstance(request, HessianRequest):
+                    results[key] = self.hessian(request, key)
+                else:
+                    keys.append(key)
+            if keys:
+                requests = [pending[key][1] for key in keys]
+                merged = self.calculate_each(
+                    [request.atoms_list for request in requests],
+                    keys=keys,
+                    outs=[
+                        None if request.out is None
+                        else (request.out, request.rows)
+                        for request in requests
+                    ],
+                )
+                results.update(zip(keys, merged))
+            for key, result in results.items():
+                steps, _ = pending.pop(key)
+                yield from self._advance(pending, key, steps, result)
@@ -0,0 +1,92 @@
+import json
+import os
+
+from ase.io import iread, write
+
+STAGES = ['relax', 'fc2', 'fc3', 'conductivity']
+STAGE_KEYS = {
+    'relax': ['Formula', 'SPG_num', 'SPG_same', 'Conv'],
+    'fc2': ['FC2_super', 'Dup_of', 'FC2_imag'],
+    'fc3': ['FC3_super'],
+    'conductivity': ['Q_mesh', 'Imaginary'],
+}
+
+
+def _to_json(obj):
+    if hasattr(obj, 'item'):
+        return obj.item()
+    return str(obj)
+
+
+class Checkpoint:
+    """
+    Per-structure, per-stage completion manifest of a pyte run.
+
+    Every finished or failed stage is appended as one JSON line to
+    manifest.jsonl, and relaxed structures are appended to relaxed.extxyz,
+    so a rerun can skip finished stages and redo only failed or missing
+    ones. A line cut off by a crash is ignored.
+    """
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = f'{directory}/manifest.jsonl'
+        self.relaxed_path = f'{directory}/relaxed.extxyz'
+        self.entries = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries.setdefault(entry['index'], {})[entry['stage']] = entry
+        self.fp = open(self.manifest_path, 'a', buffering=1)
+
+    def is_done(self, idx, stage):
+        entry = self.entries.get(idx, {}).get(stage)
+        return entry is not None and entry['done']
+
+    def done_stages(self, idx):
+        return tuple(stage for stage in STAGES if self.is_done(idx, stage))
+
+    def get(self, idx, stage, key, default=None):
+        return self.entries[idx][stage].get(key, default)
+
+    def restore_record(self, recorder, idx, stage):
+        for key, val in self.get(idx, stage, 'record', {}).items():
+            recorder.update_recorder(idx, key, val)
+
+    def mark(self, idx, stage, done, record=None, **data):
+        entry = {'index': idx, 'stage': stage, 'done': bool(done)}
+        entry['record'] = {
+            key: record[key] for key in STAGE_KEYS[stage] if key in (record or {})
+        }
+        entry.update(data)
+        self.entries.setdefault(idx, {})[stage] = entry
+        self.fp.write(json.dumps(entry, default=_to_json) + '\n')
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def save_relaxed(self, idx, atoms, record):
+        atoms = atoms.copy()
+        atoms.info['pyte_index'] = idx
+        write(self.relaxed_path, atoms, format='extxyz', append=True)
+        self.mark(idx, 'relax', True, record)
+
+    def load_relaxed(self, indices=None):
+        relaxed = {}
+        if not os.path.isfile(self.relaxed_path):
+            return relaxed
+        try:
+            for atoms in iread(self.relaxed_path, format='extxyz'):
+                idx = atoms.info.pop('pyte_index')
+                if self.is_done(idx, 'relax') and (
+                    indices is None or idx in indices
+                ):
+                    relaxed[idx] = atoms
+        except Exception:
+            pass  # last frame cut off by a crash
+        return relaxed
+
+    def close(self):
+        self.fp.close()
@@ -0,0 +1,238 @@
+import os
+
+import h5py
+import numpy as np
+
+CSV_HEADER = 'index,temperature,xx,yy,zz,yz,xz,xy\n'
+# recorded kappa of each conductivity type, named as in the output
+KAPPA_NAMES = {
+    None: {'kappa': 'kappa'},
+    'wigner': {
+        'kappa': 'kappa_TOT_RTA',
+        'kappa_p': 'kappa_P_RTA',
+        'kappa_c': 'kappa_C',
+    },
+}
+CSV_NAMES = {
+    'kappa': 'kappa_total.csv',
+    'kappa_p': 'kappa_p.csv',
+    'kappa_c': 'kappa_c.csv',
+}
+MODE_KEYS = ['qpoints', 'weights', 'frequencies', 'group_velocities', 'lifetimes']
+
+
+def postprocess_kappa_to_csv(file, idx, temps, kappas):
+    lines = []
+    for temp, kappa in zip(temps, kappas):
+        if kappa is None:
+            kappa_join = 'NaN'
+        else:
+            kappa = kappa.reshape(-1)
+            kappa_join = ','.join(map(str,kappa))
+        lines.append(f'{idx},{temp},{kappa_join}\n')
+    file.write(''.join(lines))
+    return lines
+
+
+def _kappa_array(kappa, num_temps):
+    """kappa of one structure as (num_temps, 6), NaN if it failed."""
+    if kappa is None or any(k is None for k in kappa):
+        return np.full((num_temps, 6), np.nan)
+    return np.asarray(kappa, dtype=float).reshape((num_temps, 6))
+
+
+def get_mode_data(cond, conductivity_type):
+    """
+    Mode-resolved data of a phono3py conductivity object: q-points and
+    their weights, frequencies (THz), group velocities (THz Angstrom),
+    lifetimes (ps) and mode kappa.
+    """
+    gamma = np.asarray(cond.gamma)[0]
+    with np.errstate(divide='ignore'):
+        lifetimes = np.where(gamma > 0, 1 / (4 * np.pi * gamma), 0)
+    mode_data = {
+        'qpoints': np.asarray(cond.qpoints),
+        'weights': np.asarray(cond.grid_weights),
+        'frequencies': np.asarray(cond.frequencies),
+        'group_velocities': np.asarray(cond.group_velocities),
+        'lifetimes': lifetimes,
+    }
+    mode_keys = (
+        ['mode_kappa'] if conductivity_type is None
+        else ['mode_kappa_P_RTA', 'mode_kappa_C']
+    )
+    for key in mode_keys:
+        if (mode_kappa := getattr(cond, key, None)) is not None:
+            mode_data[key] = np.asarray(mode_kappa)[0]
+    return mode_data
+
+
+class KappaCSVWriter:
+    """
+    Write kappa of each structure as one csv line per temperature.
+    Rows returned by write are kept by the checkpoint and passed back to
+    write_rows when a finished structure is restored.
+    """
+    def __init__(self, save_path, temperatures, conductivity_type, append=False):
+        self.temperatures = temperatures
+        self.names = KAPPA_NAMES[conductivity_type]
+        self.files = {}
+        for name in self.names:
+            fp = open(
+                f'{save_path}/{CSV_NAMES[name]}', 'a' if append else 'w',
+                buffering=1,
+            )
+            if not append:
+                fp.write(CSV_HEADER)
+            self.files[name] = fp
+
+    def write(self, idx, cond_dict, mesh=None, success=True, mode_data=None):
+        rows = {}
+        for name, key in self.names.items():
+            rows[CSV_NAMES[name]] = postprocess_kappa_to_csv(
+                self.files[name], idx, self.temperatures, cond_dict[key]
+            )
+        return rows
+
+    def write_rows(self, idx, rows):
+        for name, fp in self.files.items():
+            fp.write(''.join(rows.get(CSV_NAMES[name], [])))
+
+    def close(self):
+        for fp in self.files.values():
+            fp.close()
+
+
+class KappaHDF5Writer:
+    """
+    Write kappa of all structures as columns of one HDF5 file.
+
+    index, q_mesh, success and kappa (and kappa_p, kappa_c for wigner) are
+    resizable datasets along the structure axis, appended every
+    chunk_size structures. Mode data, if given, goes to modes/<index>.
+    A file left by an earlier run is reused for its mode data: rows are
+    started over, but modes/<index> of structures restored with write_rows
+    are kept, while write replaces them.
+    """
+    def __init__(
+        self, filename, temperatures, conductivity_type, append=False,
+        chunk_size=64,
+    ):
+        self.filename = filename
+        self.temperatures = np.asarray(temperatures, dtype=float)
+        self.names = KAPPA_NAMES[conductivity_type]
+        self.chunk_size = chunk_size
+        self.buffer = []
+
+        exists = os.path.isfile(filename)
+        append = append and exists
+        self.fp = h5py.File(filename, 'a' if exists else 'w')
+        if append:
+            return
+        for key in list(self.fp):
+            if key != 'modes':
+                del self.fp[key]
+        num_temps = len(self.temperatures)
+        self.fp.create_dataset('temperature', data=self.temperatures)
+        columns = {
+            'index': ((), np.int64),
+            'q_mesh': ((3,), np.int64),
+            'success': ((), bool),
+        }
+        columns.update({name: ((num_temps, 6), float) for name in self.names})
+        for name, (shape, dtype) in columns.items():
+            self.fp.create_dataset(
+                name,
+                shape=(0, *shape),
+                maxshape=(None, *shape),
+                chunks=(chunk_size, *shape),
+                dtype=dtype,
+            )
+        self.fp.require_group('modes')
+
+    def write(self, idx, cond_dict, mesh=None, success=True, mode_data=None):
+        num_temps = len(self.temperatures)
+        row = {
+            'index': idx,
+            'q_mesh': mesh if mesh is not None else [0, 0, 0],
+            'success': success,
+        }
+        for name, key in self.names.items():
+            row[name] = _kappa_array(cond_dict[key], num_temps)
+        self.buffer.append(row)
+
+        if str(idx) in self.fp['modes']:
+            del self.fp['modes'][str(idx)]  # left by an earlier run
+        if mode_data is not None:
+            group = self.fp['modes'].create_group(str(idx))
+            for key, val in mode_data.items():
+                group.create_dataset(key, data=val, compression='gzip')
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+        # kept by the checkpoint to restore this row
+        return {
+            os.path.basename(self.filename): {
+                'q_mesh': [int(m) for m in row['q_mesh']],
+                'success': bool(success),
+                **{name: row[name].tolist() for name in self.names},
+            }
+        }
+
+    def write_rows(self, idx, rows):
+        row = dict(rows[os.path.basename(self.filename)])
+        for name in self.names:
+            row[name] = np.asarray(row[name], dtype=float)
+        row['index'] = idx
+        self.buffer.append(row)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        start = self.fp['index'].shape[0]
+        stop = start + len(self.buffer)
+        for name in ['index', 'q_mesh', 'success', *self.names]:
+            dataset = self.fp[name]
+            dataset.resize(stop, axis=0)
+            dataset[start:stop] = np.array([row[name] for row in self.buffer])
+        self.buffer = []
+        self.fp.flush()
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+
+def open_kappa_writer(config, temperatures, conductivity_type, append=False):
+    save_path = config['data']['save_cond']
+    if config['conductivity']['output_format'].lower() == 'hdf5':
+        return KappaHDF5Writer(
+            f'{save_path}/kappa.hdf5', temperatures, conductivity_type, append
+        )
+    return KappaCSVWriter(save_path, temperatures, conductivity_type, append)
+
+
+def read_kappa(filename):
+    """
+    Read kappa.hdf5 written by KappaHDF5Writer. Returns a dict of arrays
+    sorted by structure index: index, temperature, q_mesh, success and
+    kappa (kappa_p, kappa_c), the latter with shape (num, num_temps, 6).
+    """
+    with h5py.File(filename, 'r') as fp:
+        data = {key: fp[key][()] for key in fp if key != 'modes'}
+    order = np.argsort(data['index'], kind='stable')
+    for key, val in data.items():
+        if key != 'temperature':
+            data[key] = val[order]
+    return data
+
+
+def read_modes(filename, idx):
+    """Mode data of idx-th structure in kappa.hdf5, or None if not saved."""
+    with h5py.File(filename, 'r') as fp:
+        if str(idx) not in fp['modes']:
+            return None
+        group = fp['modes'][str(idx)]
+        return {key: group[key][()] for key in group}
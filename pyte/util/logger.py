@@ -1,3 +1,7 @@
+import csv
+import json
+import multiprocessing as mp
+import resource
 import time
 from datetime import timedelta
 
@@ -11,9 +15,55 @@ GREETINGS += " | .__/ \__, | | |_ \___|\n"
 GREETINGS += " |_|    |___/  |___|\n"
 GREETINGS += f"                    {pyte.__version__}\n"
 
-LOG_ORDER = ['Index', 'Formula', 'SPG_num', 'SPG_same', 'Conv', 'FC2_super', 'FC3_super', 'FC_calc_error', 'Q_mesh', 'Imaginary']
+LOG_ORDER = ['Index', 'Formula', 'SPG_num', 'SPG_same', 'Conv', 'Dup_of', 'FC2_super', 'FC3_super', 'FC_calc_error', 'FC2_imag', 'Q_mesh', 'Imaginary']
+PROFILE_ORDER = ['Time_relax', 'Time_fc', 'Time_cond', 'Time_model', 'N_force_calls', 'Peak_RSS']
 RES_INTERVAL = 3
 
+
+def _status_mb(field, pid='self'):
+    """Field of /proc/<pid>/status in MB, None if unknown."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Start measuring a new peak: reset the peak resident set size (VmHWM)
+    of this process and its live worker processes. Returns whether the
+    kernel supports it.
+    """
+    try:
+        for pid in ['self'] + [child.pid for child in mp.active_children()]:
+            with open(f'/proc/{pid}/clear_refs', 'w') as f:
+                f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def get_peak_rss(since_reset=True):
+    """
+    Peak resident set size, in MB, of this process plus that of each live
+    worker process since the last reset_peak_rss. If since_reset is False
+    or /proc is not available, the peaks of this process and of its
+    largest finished child over the whole run are used instead.
+    """
+    peak = _status_mb('VmHWM') if since_reset else None
+    if peak is None:
+        return sum(
+            resource.getrusage(who).ru_maxrss / 1024
+            for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]
+        )
+    for child in mp.active_children():
+        peak += _status_mb('VmHWM', child.pid) or 0.
+    return peak
+
 class Singleton(type):
     _instances = {}
 
@@ -29,6 +79,8 @@ class ProgressBar:
         self.desc = desc
         self.init_time = time.time()
         self.bar_length = 100 - len(desc)
+        # room for growing elapsed/eta times, so the line can be rewritten
+        self.width = len(self.get_end_progress()) + 32
 
 
     def get_progress(self, idx):
@@ -66,19 +118,48 @@ class ProgressBar:
 
 class Recorder:
     def __init__(self, total_num):
-        result_dict = {k: None for k in LOG_ORDER if k != 'Index'}
-        self.result_dicts = [result_dict.copy() for _ in range(total_num)]
+        self.result_dict = {
+            k: None for k in LOG_ORDER + PROFILE_ORDER if k != 'Index'
+        }
+        self.result_dicts = [self.result_dict.copy() for _ in range(total_num)]
+        self.peak_reset = False
+
+
+    def start_stage(self):
+        """Start measuring Peak_RSS of the stage about to run."""
+        self.peak_reset = reset_peak_rss()
 
 
     def update_recorder(self, idx, key, val):
+        # grows on demand when structures are streamed
+        while idx >= len(self.result_dicts):
+            self.result_dicts.append(self.result_dict.copy())
         self.result_dicts[idx].update({key: val})
 
 
+    def add_to_recorder(self, idx, key, val):
+        prev = self.result_dicts[idx][key] if idx < len(self.result_dicts) else None
+        self.update_recorder(idx, key, val if prev is None else prev + val)
+
+
+    def record_profile(self, idx, stage, wall_time, model_time=0., num_calls=0):
+        """
+        Record the profile of one stage of idx-th structure. Peak_RSS is
+        the peak memory of the process and its workers from the start of
+        the stage (see start_stage) until the structure finished.
+        """
+        self.update_recorder(idx, f'Time_{stage}', wall_time)
+        self.add_to_recorder(idx, 'Time_model', model_time)
+        self.add_to_recorder(idx, 'N_force_calls', num_calls)
+        self.update_recorder(
+            idx, 'Peak_RSS', get_peak_rss(self.peak_reset)
+        )
+
+
 class Logger(metaclass=Singleton):
     def __init__(self, filename):
         self.fp = open(filename, 'w+', buffering=1)
         self.init_time = time.time()
-        self._erase_final = []
 
 
     def init_recorder(self, total_num):
@@ -99,21 +180,57 @@ class Logger(metaclass=Singleton):
             self.writeline(f'{k:<{max_len}} : {v}')
 
 
+    def _write_progress(self, progress):
+        """
+        Overwrite the fixed-width progress line in place, then return to
+        the end of the log so other lines keep being appended.
+        """
+        self.fp.seek(self._pbar_pos)
+        self.fp.write(f'{progress[:self.pbar.width]:<{self.pbar.width}}\n')
+        self.fp.seek(0, 2)
+
+
     def log_progress_bar(self, idx, total_len, desc='pbar'):
         if idx == 0:
-            self._epos_init = self.fp.tell()
+            self._pbar_pos = self.fp.tell()
             self.pbar = ProgressBar(total_len, desc)
-        progress = self.pbar.get_progress(idx)
-        self.fp.write(f'\r{progress}')
+        self._write_progress(self.pbar.get_progress(idx))
 
 
     def finalize_progress_bar(self):
-        progress = self.pbar.get_end_progress()
-        self._erase_final += list(range(self._epos_init, self.fp.tell()+1))
-        del self._epos_init
+        if getattr(self, 'pbar', None) is None:
+            return
+        self._write_progress(self.pbar.get_end_progress())
+        del self._pbar_pos
         del self.pbar
-        self.fp.write(f'\r{progress}')
-        self.fp.write('\n')
+
+
+    def save_profile(self, filename):
+        """
+        Write per-structure results and profile columns to filename, as
+        JSON if it ends with .json and as CSV otherwise.
+        """
+        keys = LOG_ORDER + PROFILE_ORDER
+        rows = [
+            {'Index': idx, **{k: res_dict[k] for k in keys if k != 'Index'}}
+            for idx, res_dict in enumerate(self.recorder.result_dicts)
+        ]
+        with open(filename, 'w', newline='') as f:
+            if filename.endswith('.json'):
+                json.dump(rows, f, indent=1, default=str)
+            else:
+                writer = csv.DictWriter(f, fieldnames=keys)
+                writer.writeheader()
+                writer.writerows(rows)
+
+        total = {
+            key: sum(row[key] for row in rows if row[key] is not None)
+            for key in ['Time_relax', 'Time_fc', 'Time_cond', 'Time_model']
+        }
+        self.writeline(f'Profile saved to {filename}')
+        self.writeline(
+            ', '.join(f'{key}: {val:.2f} s' for key, val in total.items())
+        )
 
 
     def log_bar(self, size=100):
@@ -130,20 +247,18 @@ class Logger(metaclass=Singleton):
     def log_results(self):
         self.writeline('')
         res_dicts = self.recorder.result_dicts
-        max_len_dict = {k: [len(f'{v}')] for k, v in res_dicts[0].items()}
+        # profile columns are saved by save_profile, not logged here
+        max_len_dict = {k: [len(k)] for k in LOG_ORDER}
         for idx, res_dict in enumerate(res_dicts):
             res_dict['Index'] = idx
-            if idx == 0:
-                max_len_dict = {k: [] for k in res_dict.keys()}
-
             for key in LOG_ORDER:
                 v = res_dict[key]
                 res_dict[key] = f'{v}'
                 max_len_dict[key].append(len(f'{v}'))
 
-        max_len_dict = {k: max(max(v), len(k)) for k, v in max_len_dict.items()}
+        max_len_dict = {k: max(v) for k, v in max_len_dict.items()}
         widths = [max_len_dict[key] for key in LOG_ORDER]
-        bar_len = RES_INTERVAL*(len(LOG_ORDER)+1) + sum(max_len_dict.values())
+        bar_len = RES_INTERVAL*(len(LOG_ORDER)+1) + sum(widths)
 
         self.log_bar(bar_len)
         self.writeline(self._make_string_with_space(LOG_ORDER, widths))
@@ -159,14 +274,5 @@ class Logger(metaclass=Singleton):
         total = time.time() - self.init_time
         self.writeline(f'Total elapsed time: {timedelta(seconds=total)}')
         self.writeline('pyte terminated.')
-        self.fp.seek(0)
-        final = ''
-        for idx, char in enumerate(self.fp.read()):
-            if idx in self._erase_final:
-                continue
-            final += char
-        self.fp.seek(0)
-        self.fp.write(final)
-        self.fp.truncate()
         self.fp.close()
 
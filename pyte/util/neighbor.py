@@ -0,0 +1,82 @@
+from collections import OrderedDict
+
+import numpy as np
+
+import sevenn._keys as KEY
+import sevenn.train.dataload as dataload
+
+
+class NeighborListCache:
+    """
+    Build SevenNet graphs of displaced supercells from a cached reference.
+
+    The first structure seen with a given cell and species is the
+    reference. Its neighbor list is built once with cutoff + skin, and
+    later structures reuse its edges, with positions and edge vectors
+    shifted by the atomic displacements and edges beyond cutoff dropped.
+    This is exact while the two largest displacements from the reference
+    sum to less than skin. Otherwise, or if an atom was wrapped into
+    another image, the structure is built from scratch and becomes the
+    new reference.
+    At most max_entries references are kept, least recently used first out.
+    """
+    def __init__(self, cutoff, skin, max_entries=16):
+        self.cutoff = cutoff
+        self.skin = skin
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._refs = OrderedDict()
+
+    @staticmethod
+    def _key(atoms):
+        return (
+            len(atoms),
+            atoms.get_atomic_numbers().tobytes(),
+            np.round(atoms.get_cell().array, 8).tobytes(),
+            atoms.get_pbc().tobytes(),
+        )
+
+    def _within_cutoff(self, graph, edge_vec):
+        mask = np.linalg.norm(edge_vec, axis=1) < self.cutoff
+        graph[KEY.EDGE_IDX] = graph[KEY.EDGE_IDX][:, mask]
+        graph[KEY.EDGE_VEC] = edge_vec[mask]
+        if KEY.CELL_SHIFT in graph:
+            graph[KEY.CELL_SHIFT] = graph[KEY.CELL_SHIFT][mask]
+        return graph
+
+    def _displaced(self, ref, pos):
+        dpos = pos - ref[KEY.POS]
+        frac = dpos @ np.linalg.inv(ref[KEY.CELL])
+        if np.any(np.abs(frac) > 0.5):
+            return None  # wrapped into another image
+        moved = np.sort(np.linalg.norm(dpos, axis=1))[-2:]
+        if moved.sum() >= self.skin:
+            return None
+
+        graph = dict(ref)
+        graph[KEY.POS] = pos
+        graph[KEY.INFO] = {}
+        src, dst = ref[KEY.EDGE_IDX]
+        edge_vec = ref[KEY.EDGE_VEC] + dpos[dst] - dpos[src]
+        return self._within_cutoff(graph, edge_vec)
+
+    def build(self, atoms):
+        """Graph of atoms as returned by unlabeled_atoms_to_graph."""
+        key = self._key(atoms)
+        if (ref := self._refs.get(key)) is not None:
+            self._refs.move_to_end(key)
+            graph = self._displaced(ref, atoms.get_positions())
+            if graph is not None:
+                self.hits += 1
+                return graph
+
+        # new or moved too far from the reference, which it replaces
+        self.misses += 1
+        ref = dataload.unlabeled_atoms_to_graph(atoms, self.cutoff + self.skin)
+        self._refs[key] = ref
+        if len(self._refs) > self.max_entries:
+            self._refs.popitem(last=False)
+        graph = dict(ref)
+        graph[KEY.INFO] = {}
+        return self._within_cutoff(graph, ref[KEY.EDGE_VEC])
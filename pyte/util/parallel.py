@@ -0,0 +1,156 @@
+import multiprocessing as mp
+import queue
+import time
+
+
+class CalculatorClient:
+    """
+    Stand-in calculator for worker processes. Structures are sent to the
+    parent process, which owns the real calculator, and the calculated
+    atoms are sent back, or only their forces if forces_out is given.
+    """
+    def __init__(self, worker_id, requests, responses):
+        self.worker_id = worker_id
+        self.requests = requests
+        self.responses = responses
+        self.idx = None  # task being processed, for profiling
+
+    def batch_calculate(
+        self, atoms_list, desc=None, cache=None, forces_out=None, rows=None
+    ):
+        # results are cached by the parent process
+        self.requests.put((
+            'calc',
+            (self.worker_id, self.idx),
+            (atoms_list, forces_out is not None),
+        ))
+        result = self.responses.get()
+        if isinstance(result, Exception):
+            raise result
+        if forces_out is None:
+            return result
+        for row, forces in zip(rows, result):
+            forces_out[row] = forces
+        return forces_out
+
+
+def _worker_loop(worker_id, func, args, tasks, requests, responses):
+    calc = CalculatorClient(worker_id, requests, responses)
+    while (task := tasks.get()) is not None:
+        idx, item = task
+        calc.idx = idx
+        requests.put(('start', (worker_id, idx), None))
+        init_time = time.time()
+        try:
+            result = func(*args, idx, item, calc)
+        except Exception as e:
+            result = e
+        requests.put(
+            ('done', (worker_id, idx), (result, time.time() - init_time))
+        )
+
+
+def _drain(requests):
+    messages = []
+    while True:
+        try:
+            messages.append(requests.get_nowait())
+        except queue.Empty:
+            return messages
+
+
+def run_with_calculator_server(
+    func, args, items, scheduler, num_workers, poll_interval=1.,
+):
+    """
+    Run func(*args, idx, item, calc) for every (idx, item) pair of items
+    in worker processes.
+    The calculator stays in this process behind a DisplacementScheduler:
+    force requests that arrive from different workers at the same time
+    are merged into one evaluation, and the CPU work of one structure
+    overlaps with model inference for another. Yields (idx, result) in
+    completion order; an exception raised by func is yielded as result.
+    Profiles of each task are collected in scheduler.stats.
+    Workers are checked every poll_interval seconds without messages: the
+    task of a worker that died is yielded with a RuntimeError, and if no
+    worker is left while tasks remain, RuntimeError is raised.
+    """
+    ctx = mp.get_context('spawn')
+    tasks = ctx.Queue()
+    requests = ctx.Queue()
+    responses = [ctx.Queue() for _ in range(num_workers)]
+    workers = [
+        ctx.Process(
+            target=_worker_loop,
+            args=(wid, func, args, tasks, requests, responses[wid]),
+            daemon=True,
+        )
+        for wid in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for idx, item in items:
+        tasks.put((idx, item))
+    for _ in workers:
+        tasks.put(None)
+
+    num_left = len(items)
+    running = {}  # worker id -> task being processed
+    try:
+        while num_left:
+            try:
+                messages = [requests.get(timeout=poll_interval)]
+            except queue.Empty:
+                # a worker flushes its messages before exiting, so anything
+                # it sent is drained here if it exited before this point
+                exited = {
+                    wid for wid, worker in enumerate(workers)
+                    if worker.exitcode is not None
+                }
+                messages = _drain(requests)
+                if not messages:
+                    for wid in sorted(exited & running.keys()):
+                        idx = running.pop(wid)
+                        num_left -= 1
+                        yield idx, RuntimeError(
+                            f'Worker {wid} exited with code '
+                            f'{workers[wid].exitcode} while processing {idx}'
+                        )
+                    if num_left and len(exited) == len(workers):
+                        raise RuntimeError(
+                            f'All workers exited with {num_left} tasks left'
+                        )
+                    continue
+            messages += _drain(requests)
+
+            calc_messages = []
+            for kind, (wid, idx), payload in messages:
+                if kind == 'start':
+                    running[wid] = idx
+                elif kind == 'calc':
+                    calc_messages.append(((wid, idx), payload))
+                else:
+                    running.pop(wid, None)
+                    num_left -= 1
+                    result, wall_time = payload
+                    scheduler.key_stats(idx)['wall_time'] += wall_time
+                    yield idx, result
+            if not calc_messages:
+                continue
+
+            results = scheduler.calculate_each(
+                [atoms_list for _, (atoms_list, _) in calc_messages],
+                keys=[idx for (_, idx), _ in calc_messages],
+                outs=[
+                    ([None] * len(atoms_list), range(len(atoms_list)))
+                    if forces_only else None
+                    for _, (atoms_list, forces_only) in calc_messages
+                ],
+            )
+            for ((wid, _), _), result in zip(calc_messages, results):
+                responses[wid].put(result)
+    finally:
+        for worker in workers:
+            if num_left:
+                worker.terminate()
+            worker.join()
@@ -5,6 +5,7 @@ import warnings
 from ase import Atoms
 import spglib
 
+from phonopy import Phonopy
 from phonopy.structure.atoms import PhonopyAtoms
 
 
@@ -69,6 +70,22 @@ def check_imaginary_freqs(frequencies: np.ndarray) -> bool:
     return False
 
 
+def fc2_has_imaginary(ph3, mesh):
+    """
+    Whether harmonic phonons of ph3.fc2 on a Gamma-centered mesh have
+    imaginary modes, judged by check_imaginary_freqs.
+    """
+    phonon = Phonopy(
+        ph3.unitcell,
+        supercell_matrix=ph3.phonon_supercell_matrix,
+        primitive_matrix=ph3.primitive_matrix,
+        symprec=1e-5,
+    )
+    phonon.force_constants = ph3.fc2
+    phonon.run_mesh(mesh, is_gamma_center=True)
+    return check_imaginary_freqs(phonon.mesh.frequencies)
+
+
 def get_spgnum(atoms, symprec=1e-5):
     cell = (atoms.get_cell(), atoms.get_scaled_positions(), atoms.get_atomic_numbers())
     spgdat = spglib.get_symmetry_dataset(cell, symprec=symprec)
@@ -110,3 +127,59 @@ def rotate_atoms(orig_atoms, prec=1e-10):
     warnings.warn(f'Rotating atoms change symmetry (from {orig_spgnum} to {spgnum}')
     warnings.warn(f'We will not rotate atoms, but be careful when using ShengBTE')
     return orig_atoms
+
+
+def _standardize(atoms, symprec=1e-5):
+    cell = (atoms.get_cell(), atoms.get_scaled_positions(), atoms.get_atomic_numbers())
+    spgdat = spglib.get_symmetry_dataset(cell, symprec=symprec)
+    std_cell = spglib.standardize_cell(cell, to_primitive=True, symprec=symprec)
+    formula = atoms.get_chemical_formula(empirical=True)
+    return (spgdat.number, formula, len(std_cell[2]), len(atoms)), std_cell
+
+
+def _same_structure(std_cell1, std_cell2, tol):
+    """
+    Whether two spglib standardized cells have the same lattice and, with
+    some one-to-one mapping of their atoms, the same species and
+    positions, all within tol (Angstrom).
+    """
+    lattice1, positions1, numbers1 = std_cell1
+    lattice2, positions2, numbers2 = std_cell2
+    if len(numbers1) != len(numbers2):
+        return False
+    if not np.allclose(lattice1, lattice2, rtol=0., atol=tol):
+        return False
+    diff = positions1[:, None, :] - positions2[None, :, :]
+    diff -= np.round(diff)
+    match = (
+        (np.linalg.norm(diff @ lattice1, axis=2) < tol)
+        & (numbers1[:, None] == numbers2[None, :])
+    )
+    return bool(np.all(match.sum(axis=0) == 1) and np.all(match.sum(axis=1) == 1))
+
+
+def find_duplicates(atoms_list, tol=1e-3, symprec=1e-5):
+    """
+    Return, for each structure, the index of the first structure in
+    atoms_list it duplicates (its own index if none).
+    Structures are bucketed by space group, composition and number of
+    atoms. Within a bucket they count as duplicates if their spglib
+    standardized primitive cells agree within tol (Angstrom), up to
+    orientation and atom order. Structures differing only by an origin
+    shift are not detected. Duplicates share the force constants and
+    kappa of their representative, which are given in the cell of the
+    representative.
+    """
+    buckets = {}
+    dup_of = []
+    for idx, atoms in enumerate(atoms_list):
+        key, std_cell = _standardize(atoms, symprec)
+        bucket = buckets.setdefault(key, [])
+        for rep, rep_cell in bucket:
+            if _same_structure(rep_cell, std_cell, tol):
+                dup_of.append(rep)
+                break
+        else:
+            bucket.append((idx, std_cell))
+            dup_of.append(idx)
+    return dup_of
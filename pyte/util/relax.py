@@ -1,7 +1,15 @@
+import sys
+import threading
+import time
+from tqdm import tqdm
+
+from ase.calculators.calculator import Calculator, all_changes
 from ase.constraints import FixSymmetry
 from ase.filters import UnitCellFilter, FrechetCellFilter
 from ase.optimize import LBFGS, FIRE
 
+from pyte.util.calc import split_by_atoms
+
 OPT_DICT = {'fire': FIRE, 'lbfgs': LBFGS}
 FILTER_DICT = {'frechet': FrechetCellFilter, 'unitcell': UnitCellFilter}
 
@@ -41,9 +49,171 @@ class AseAtomRelax:
         return atoms, conv
 
 
+class _LockstepBatcher:
+    """
+    Force requests of the optimizer threads of BatchAseAtomRelax. Once
+    every running thread waits for forces, all requests are evaluated with
+    one batch_calculate call and handed back. A thread counts as running
+    until it calls finish, also between the structures it relaxes.
+    """
+    def __init__(self, calc, num_threads, stats):
+        self.calc = calc
+        self.running = num_threads
+        self.stats = stats
+        self.pending = {}
+        self.results = {}
+        self.cond = threading.Condition()
+
+    def _evaluate(self):
+        # called with the lock held, by the last thread to arrive
+        keys = list(self.pending)
+        atoms_list = [self.pending[key] for key in keys]
+        init_time = time.time()
+        try:
+            result = self.calc.batch_calculate(atoms_list)
+        except Exception as e:
+            result = [e] * len(keys)
+        shares = split_by_atoms(
+            time.time() - init_time, [[atoms] for atoms in atoms_list]
+        )
+        for key, calculated, share in zip(keys, result, shares):
+            self.results[key] = calculated
+            self.stats[key]['model_time'] += share
+            self.stats[key]['num_calls'] += 1
+        self.pending = {}
+        self.cond.notify_all()
+
+    def request(self, key, atoms):
+        with self.cond:
+            self.pending[key] = atoms
+            if len(self.pending) == self.running:
+                self._evaluate()
+            while key not in self.results:
+                self.cond.wait()
+            result = self.results.pop(key)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def finish(self):
+        with self.cond:
+            self.running -= 1
+            if self.pending and len(self.pending) == self.running:
+                self._evaluate()
+
+
+class _LockstepCalculator(Calculator):
+    implemented_properties = ['energy', 'free_energy', 'forces', 'stress']
+
+    def __init__(self, batcher, key):
+        super().__init__()
+        self.batcher = batcher
+        self.key = key
+
+    def calculate(self, atoms=None, properties=None, system_changes=all_changes):
+        super().calculate(atoms, properties, system_changes)
+        results = self.batcher.request(self.key, self.atoms).calc.results
+        self.results = {
+            'energy': results['energy'],
+            # filters ask for force-consistent energy
+            'free_energy': results['energy'],
+            'forces': results['forces'],
+            'stress': results['stress'],
+        }
+
+
+class BatchAseAtomRelax(AseAtomRelax):
+    """
+    Relax many structures in lockstep. Each structure is relaxed by its
+    own optimizer, driven through irun() in a thread, so observers, logs
+    and convergence checks are ASE's own. Force requests of all threads
+    are gathered and evaluated with a single batch_calculate call per
+    step. At most max_active threads run; once a structure converges its
+    thread takes the next one.
+    After relax_atoms_list, stats holds the wall time until convergence,
+    the share of calculator time and the number of force calls of each
+    structure, and errors the exception of each structure that failed,
+    which is returned as not converged.
+    """
+    def __init__(self, *args, max_active=64, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_active = max_active
+
+    def _init_opt(self, atoms, logfile):
+        if self.fix_symm:
+            atoms.set_constraint(FixSymmetry(atoms, symprec=1e-5))
+
+        if self.cell_filter is not None:
+            return self.opt(self.cell_filter(atoms), logfile=logfile)
+        return self.opt(atoms, logfile=logfile)
+
+    def _relax(self, idx, atoms, logfile):
+        init_time = time.time()
+        try:
+            opt = self._init_opt(atoms, logfile)
+            conv = False
+            for conv in opt.irun(fmax=self.fmax, steps=self.steps):
+                pass
+            self.convs[idx] = bool(conv)
+        except Exception as e:
+            sys.stderr.write(f'Relax error at {idx}: {e}\n')
+            self.errors[idx] = e
+        finally:
+            atoms.calc = None
+            self.stats[idx]['wall_time'] = time.time() - init_time
+            self.pbar.update()
+
+    def _run_thread(self, todo, logfile):
+        try:
+            while True:
+                with self.todo_lock:
+                    item = next(todo, None)
+                if item is None:
+                    break
+                self._relax(*item, logfile)
+        finally:
+            self.batcher.finish()
+
+    def relax_atoms_list(self, atoms_list, desc=None):
+        atoms_list = [atoms.copy() for atoms in atoms_list]
+        logfile = self.log if self.log == '-' else open(self.log, 'a')
+        self.convs = [False] * len(atoms_list)
+        self.errors = {}
+        self.stats = [
+            {'wall_time': 0., 'model_time': 0., 'num_calls': 0}
+            for _ in atoms_list
+        ]
+        num_threads = min(self.max_active, len(atoms_list))
+        self.batcher = _LockstepBatcher(self.calc, num_threads, self.stats)
+        for idx, atoms in enumerate(atoms_list):
+            atoms.calc = _LockstepCalculator(self.batcher, idx)
+        todo = enumerate(atoms_list)
+        self.todo_lock = threading.Lock()
+
+        self.pbar = tqdm(total=len(atoms_list), desc=desc, leave=False)
+        threads = []
+        for _ in range(num_threads):
+            thread = threading.Thread(
+                target=self._run_thread, args=(todo, logfile), daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.pbar.close()
+
+        if logfile != '-':
+            logfile.close()
+        return list(zip(atoms_list, self.convs))
+
+
 def aar_from_config(config, calc):
-    arr_args = config['relax']
+    arr_args = config['relax'].copy()
     arr_args.pop('relaxed_input_path', None)
+    batch_relax = arr_args.pop('batch_relax', False)
+    max_active = arr_args.pop('batch_structures', None)
+    if max_active is None:
+        max_active = getattr(calc, 'batch_size', None)
 
     opt = OPT_DICT[arr_args['opt'].lower()]
     cell_filter = arr_args.get('cell_filter', None)
@@ -54,6 +224,11 @@ def aar_from_config(config, calc):
     arr_args['opt'] = opt
     arr_args['cell_filter'] = cell_filter
 
+    # calculators without calculate (e.g. ParallelCalculator) only batch
+    if hasattr(calc, 'batch_calculate') and (
+        batch_relax or not hasattr(calc, 'calculate')
+    ):
+        if max_active is not None:
+            arr_args['max_active'] = max_active
+        return BatchAseAtomRelax(**arr_args)
     return AseAtomRelax(**arr_args)
-    
-    
@@ -44,7 +44,8 @@ setup(
     ext_modules=extensions,
     entry_points={
         "console_scripts": [
-            "pyte = pyte.scripts.main:main"
+            "pyte = pyte.scripts.main:main",
+            "pyte-benchmark = pyte.scripts.benchmark:main",
         ]
     },
 )
@@ -0,0 +1,33 @@
+import pytest
+
+from pyte.util.logger import LOG_ORDER, Logger, Singleton
+
+
+@pytest.fixture
+def logger(tmp_path):
+    Singleton._instances.pop(Logger, None)
+    logger = Logger(str(tmp_path / 'log'))
+    yield logger
+    logger.fp.close()
+    Singleton._instances.pop(Logger, None)
+
+
+def test_log_results_with_profile_columns(logger):
+    logger.init_recorder(2)
+    recorder = logger.recorder
+    for idx in range(2):
+        recorder.update_recorder(idx, 'Formula', 'Si2')
+        recorder.update_recorder(idx, 'Conv', True)
+        recorder.record_profile(idx, 'relax', 1.5, model_time=1., num_calls=3)
+        recorder.record_profile(idx, 'fc', 10.25, model_time=8., num_calls=12)
+
+    logger.log_results()
+
+    logger.fp.seek(0)
+    lines = logger.fp.read().splitlines()
+    header = next(line for line in lines if 'Formula' in line)
+    assert header.split() == LOG_ORDER
+    rows = [line.split() for line in lines if 'Si2' in line]
+    assert [row[0] for row in rows] == ['0', '1']
+    assert all(len(row) == len(LOG_ORDER) for row in rows)
+    assert not any('Time_relax' in line for line in lines)
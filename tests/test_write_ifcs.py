@@ -0,0 +1,137 @@
+import io
+import itertools
+
+import numpy as np
+import pytest
+
+from pyte.thirdorder.thirdorder_common import (
+    SparseIFCs,
+    calc_dists,
+    calc_frange,
+    gen_SPOSCAR,
+    write_ifcs,
+)
+
+
+def reference_write_ifcs(phifull, poscar, sposcar, dmin, nequi, shifts,
+                         frange, filename):
+    """write_ifcs as shipped before the vectorized rewrite."""
+    natoms = len(poscar["types"])
+    ntot = len(sposcar["types"])
+
+    shifts27 = list(itertools.product(range(-1, 2), range(-1, 2),
+                                      range(-1, 2)))
+    frange2 = frange * frange
+
+    nblocks = 0
+    f = io.StringIO()
+    for ii, jj in itertools.product(range(natoms), range(ntot)):
+        if dmin[ii, jj] >= frange:
+            continue
+        jatom = jj % natoms
+        shiftsij = [shifts27[i] for i in shifts[ii, jj, :nequi[ii, jj]]]
+        for kk in range(ntot):
+            if dmin[ii, kk] >= frange:
+                continue
+            katom = kk % natoms
+            shiftsik = [shifts27[i] for i in shifts[ii, kk, :nequi[ii, kk]]]
+            d2min = np.inf
+            for shift2 in shiftsij:
+                carj = np.dot(sposcar["lattvec"],
+                              shift2 + sposcar["positions"][:, jj])
+                for shift3 in shiftsik:
+                    cark = np.dot(sposcar["lattvec"],
+                                  shift3 + sposcar["positions"][:, kk])
+                    d2 = ((carj - cark)**2).sum()
+                    if d2 < d2min:
+                        best2 = shift2
+                        best3 = shift3
+                        d2min = d2
+            if d2min >= frange2:
+                continue
+            nblocks += 1
+            Rj = np.dot(sposcar["lattvec"],
+                        best2 + sposcar["positions"][:, jj]
+                        - sposcar["positions"][:, jatom])
+            Rk = np.dot(sposcar["lattvec"],
+                        best3 + sposcar["positions"][:, kk]
+                        - sposcar["positions"][:, katom])
+            f.write("\n")
+            f.write("{:>5}\n".format(nblocks))
+            f.write("{0[0]:>15.10e} {0[1]:>15.10e} {0[2]:>15.10e}\n".format(
+                list(10. * Rj)))
+            f.write("{0[0]:>15.10e} {0[1]:>15.10e} {0[2]:>15.10e}\n".format(
+                list(10. * Rk)))
+            f.write("{:>6d} {:>6d} {:>6d}\n".format(ii + 1, jatom + 1,
+                                                    katom + 1))
+            for ll, mm, nn in itertools.product(range(3), range(3),
+                                                range(3)):
+                f.write("{:>2d} {:>2d} {:>2d} {:>20.10e}\n".format(
+                    ll + 1, mm + 1, nn + 1, phifull[ll, mm, nn, ii, jj, kk]))
+    with open(filename, "w") as ffinal:
+        ffinal.write("{:>5}\n".format(nblocks))
+        ffinal.write(f.getvalue())
+
+
+def diamond_poscar():
+    a = 0.5431  # nm
+    return {
+        "lattvec": 0.5 * a * np.array([[0., 1., 1.],
+                                       [1., 0., 1.],
+                                       [1., 1., 0.]]),
+        "positions": np.array([[0., 0.25],
+                               [0., 0.25],
+                               [0., 0.25]]),
+        "elements": ["Si"],
+        "numbers": np.array([2], dtype=np.intc),
+        "types": [0, 0],
+    }
+
+
+def wurtzite_poscar():
+    a, c, u = 0.3189, 0.5185, 0.377  # nm
+    return {
+        "lattvec": np.array([[a, -0.5 * a, 0.],
+                             [0., np.sqrt(3.) / 2. * a, 0.],
+                             [0., 0., c]]),
+        "positions": np.array([[1. / 3., 2. / 3., 1. / 3., 2. / 3.],
+                               [2. / 3., 1. / 3., 2. / 3., 1. / 3.],
+                               [0., 0.5, u, 0.5 + u]]),
+        "elements": ["Ga", "N"],
+        "numbers": np.array([2, 2], dtype=np.intc),
+        "types": [0, 0, 1, 1],
+    }
+
+
+@pytest.mark.parametrize("make_poscar,supercell,nneigh", [
+    (diamond_poscar, (2, 2, 2), 3),
+    (diamond_poscar, (3, 3, 3), 4),
+    (wurtzite_poscar, (3, 3, 2), 3),
+])
+@pytest.mark.parametrize("chunksize", [1, 7, 64])
+def test_write_ifcs_matches_reference(tmp_path, make_poscar, supercell,
+                                      nneigh, chunksize):
+    poscar = make_poscar()
+    natoms = len(poscar["types"])
+    sposcar = gen_SPOSCAR(poscar, *supercell)
+    ntot = len(sposcar["types"])
+    dmin, nequi, shifts = calc_dists(sposcar)
+    frange = calc_frange(poscar, sposcar, nneigh, dmin)
+
+    # Random IFCs on a random subset of triplets, so that missing
+    # triplets are written as zeros by both writers.
+    rng = np.random.default_rng(0)
+    triplets = np.array(list(itertools.product(
+        range(natoms), range(ntot), range(ntot))))
+    triplets = triplets[rng.random(len(triplets)) < 0.7]
+    values = rng.normal(size=(len(triplets), 3, 3, 3))
+    phi = SparseIFCs(triplets, values, natoms, ntot)
+
+    expected = tmp_path / "FORCE_CONSTANTS_3RD.expected"
+    actual = tmp_path / "FORCE_CONSTANTS_3RD"
+    reference_write_ifcs(phi.todense(), poscar, sposcar, dmin, nequi,
+                         shifts, frange, str(expected))
+    write_ifcs(phi, poscar, sposcar, dmin, nequi, shifts, frange,
+               str(actual), chunksize=chunksize)
+
+    assert actual.read_bytes() == expected.read_bytes()